@@ -0,0 +1,272 @@
+"""Long-running asyncio poller that feeds the blockchain from many Modbus/TCP devices.
+
+Every device in the inventory gets its own connection and a task that issues the device's polls at the device's
+interval. The tasks' start times are spread evenly over each interval, so thousands of devices don't all poll at
+once. Each response is hashed with cmd_hash and added to the blockchain's pending transactions as a (response, hash)
+cmd_tuple, the same shape ModbusTransaction.cmd_and_hash gives.
+
+- At most `max_in_flight` requests are outstanding across all devices; the rest wait for a slot.
+- Every request has a timeout. A device that times out or drops its connection is reconnected on its next poll, after
+  an exponential backoff kept per device, so a dead device only ever costs its own task time.
+- A device that falls behind its interval skips the polls it missed instead of bursting to catch up.
+
+Requests are framed and decoded with pymodbus' own message classes, so the responses and their hashes are the same as
+the synchronous client's. One request is outstanding per connection, which every Modbus/TCP device supports.
+Transaction ids are numbered across all devices rather than per connection, so the same response from two devices
+still gets two hashes.
+
+Polling 5k devices keeps 5k sockets open; raise the open file limit (ulimit -n) to match.
+"""
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from pymodbus.client.common import ModbusClientMixin
+from pymodbus.factory import ClientDecoder
+from pymodbus.framer.socket_framer import ModbusSocketFramer
+
+from Modbus.hashing_server import cmd_hash, read_frame, transaction_ids
+from pipeline import mine_block
+
+
+class _RequestBuilder(ModbusClientMixin):
+    """pymodbus client methods (read_coils, write_coil, ...) that return the request instead of sending it"""
+    def execute(self, request):
+        return request
+
+
+class Device:
+    """One Modbus/TCP device in the inventory.
+
+    :param host: Address of the device (or of the gateway in front of it)
+    :param port: Modbus/TCP port
+    :param unit: Unit id; pymodbus' default unit if None
+    :param interval: Seconds between polls
+    :param polls: (client method, *args) tuples issued in order on every poll, e.g. ("read_coils", 1, 8)
+    :param sender: Sender recorded in the transactions, i.e. this node
+    :param recipient: Recipient recorded in the transactions; the device's host and port if None
+    """
+    def __init__(self, host, port=502, unit=None, interval=1.0, polls=(("write_coil", 1, False),), sender="127.0.0.1",
+                 recipient=None):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.interval = interval
+        self.polls = [tuple(poll) for poll in polls]
+        self.sender = sender
+        self.recipient = recipient or f"{host}:{port}"
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(**entry)
+
+
+def load_inventory(path):
+    """Devices from a JSON file holding a list of Device keyword arguments"""
+    with open(path) as inventory:
+        return [Device.from_dict(entry) for entry in json.load(inventory)]
+
+
+class _Connection:
+    """Connection to one device; requests on it are sent one at a time"""
+    def __init__(self, device):
+        self.device = device
+        self.reader = None
+        self.writer = None
+        self.transaction_id = None
+        self.timed_out = False
+        self.failures = 0
+        self.retry_at = 0.0
+
+    async def exchange(self, request, transaction_id, framer, decoder):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.device.host, self.device.port)
+
+        self.transaction_id = request.transaction_id = transaction_id
+        self.writer.write(framer.buildPacket(request))
+
+        transaction_id, protocol_id, unit_id, pdu = await read_frame(self.reader)
+        if transaction_id != self.transaction_id:
+            raise ConnectionError(f"Response to transaction {transaction_id} while waiting for {self.transaction_id}")
+
+        response = decoder.decode(pdu)
+        if response is None:
+            raise ConnectionError(f"Undecodable response from {self.device.host}:{self.device.port}")
+        response.transaction_id = transaction_id
+        response.protocol_id = protocol_id
+        response.unit_id = unit_id
+
+        return response
+
+    def time_out(self, task):
+        """Abandon the request in flight by cancelling the task waiting for it"""
+        self.timed_out = True
+        task.cancel()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class AsyncPoller:
+    """Polls an inventory of devices and adds every response to a blockchain's pending transactions.
+
+    :param blockchain: Blockchain whose mempool receives the transactions
+    :param devices: Iterable of Device
+    :param max_in_flight: Most requests outstanding at once across all devices
+    :param timeout: Seconds to wait for a connection or a response
+    :param backoff: Seconds a device is left alone after its first failure; doubled after every further failure
+    :param max_backoff: Longest a failing device is left alone
+    :param mine_every: Seconds between blocks mined from the pending transactions; None leaves mining to the caller
+    """
+    def __init__(self, blockchain, devices, max_in_flight=500, timeout=3.0, backoff=1.0, max_backoff=60.0,
+                 mine_every=None):
+        self.blockchain = blockchain
+        self.devices = list(devices)
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.mine_every = mine_every
+        self.stats = {"requests": 0, "responses": 0, "exceptions": 0, "timeouts": 0, "errors": 0, "skipped": 0,
+                      "rejected": 0, "blocks": 0}
+        self._builder = _RequestBuilder()
+        self._framer = ModbusSocketFramer(ClientDecoder())
+        self._decoder = ClientDecoder()
+        self._transaction_ids = transaction_ids()
+        self._slots = None
+        self._stopping = None
+        self._sleeping = set()  # Device tasks waiting for their next poll
+
+    def stop(self):
+        """Ask run() to return once the requests in flight are done"""
+        if self._stopping is not None:
+            self._stopping.set()
+            for task in self._sleeping:
+                task.cancel()
+
+    async def run(self, duration=None):
+        """Poll until stop() is called or `duration` seconds have passed; returns the poller statistics"""
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._stopping = asyncio.Event()
+        started = time.monotonic()
+
+        with ProcessPoolExecutor(1) as pool:  # Proof of work, unless the blockchain has a ParallelMiner
+            polling = asyncio.gather(*(self._poll_device(device, position) for position, device in
+                                       enumerate(self.devices)))
+            mining = asyncio.ensure_future(self._mine(pool)) if self.mine_every is not None else None
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), duration)
+            except asyncio.TimeoutError:
+                self.stop()
+            await polling
+            if mining is not None:
+                await mining
+                while len(self.blockchain.mempool):  # Whatever arrived during the last block
+                    await self._mine_block(pool)
+
+        self.stats["elapsed"] = time.monotonic() - started
+        self.stats["responses_per_sec"] = self.stats["responses"] / self.stats["elapsed"]
+
+        return self.stats
+
+    async def _sleep_until(self, moment):
+        """Sleep until a loop time; returns False if the poller is stopped first
+
+        stop() cancels the sleep, which is cheaper than racing every sleep against the stop event.
+        """
+        task = asyncio.current_task()
+        self._sleeping.add(task)
+        try:
+            if not self._stopping.is_set():
+                await asyncio.sleep(moment - asyncio.get_running_loop().time())
+        except asyncio.CancelledError:
+            if not self._stopping.is_set():
+                raise
+        finally:
+            self._sleeping.discard(task)
+
+        return not self._stopping.is_set()
+
+    async def _poll_device(self, device, position):
+        loop = asyncio.get_running_loop()
+        connection = _Connection(device)
+        requests = [getattr(self._builder, method)(*args, **({} if device.unit is None else {"unit": device.unit}))
+                    for method, *args in device.polls]
+        # Spread the devices' first polls over one interval
+        next_poll = loop.time() + device.interval * position / len(self.devices)
+
+        try:
+            while await self._sleep_until(max(next_poll, connection.retry_at)):
+                for request in requests:
+                    if not await self._request(connection, request):
+                        break
+
+                next_poll += device.interval
+                now = loop.time()
+                if next_poll < now:
+                    missed = int((now - next_poll) // device.interval) + 1
+                    self.stats["skipped"] += missed
+                    next_poll += missed * device.interval
+        finally:
+            connection.close()
+
+    async def _request(self, connection, request):
+        """Send one request and record its response; returns False if the device failed"""
+        async with self._slots:
+            self.stats["requests"] += 1
+            transaction_id = next(self._transaction_ids)
+            # A timer rather than wait_for, which would start another task for every request
+            connection.timed_out = False
+            timer = asyncio.get_running_loop().call_later(self.timeout, connection.time_out, asyncio.current_task())
+            try:
+                response = await connection.exchange(request, transaction_id, self._framer, self._decoder)
+            except (asyncio.CancelledError, OSError, asyncio.IncompleteReadError) as error:
+                if isinstance(error, asyncio.CancelledError) and not connection.timed_out:
+                    raise
+                self.stats["timeouts" if connection.timed_out else "errors"] += 1
+                connection.close()
+                connection.failures += 1
+                delay = min(self.backoff * 2 ** (connection.failures - 1), self.max_backoff)
+                connection.retry_at = asyncio.get_running_loop().time() + delay
+                return False
+            finally:
+                timer.cancel()
+
+        connection.failures = 0
+        self.stats["responses"] += 1
+        if response.isError():
+            self.stats["exceptions"] += 1
+
+        device = connection.device
+        if self.blockchain.new_transaction(device.sender, device.recipient, (response, cmd_hash(response))) is None:
+            self.stats["rejected"] += 1
+
+        return True
+
+    async def _mine(self, pool):
+        """Mine the pending transactions every `mine_every` seconds until the poller stops"""
+        loop = asyncio.get_running_loop()
+        while await self._sleep_until(loop.time() + self.mine_every):
+            if len(self.blockchain.mempool):
+                await self._mine_block(pool)
+
+    async def _mine_block(self, pool):
+        """Mine one block from the pending transactions; proof of work runs outside the event loop (see mine_block)"""
+        await mine_block(self.blockchain, pool)
+        self.stats["blocks"] += 1
+
+
+if __name__ == "__main__":
+    import sys
+
+    from modbus_blockchain import Blockchain
+
+    devices = load_inventory(sys.argv[1]) if len(sys.argv) > 1 else [Device("localhost", 5020)]
+    poller = AsyncPoller(Blockchain(), devices, mine_every=1.0)
+    stats = asyncio.run(poller.run(10))
+    print(f"{stats['responses']} responses from {len(devices)} devices in {stats['blocks']} blocks, "
+          f"{stats['responses_per_sec']:.1f} responses/sec, {stats['timeouts']} timeouts, {stats['errors']} errors")
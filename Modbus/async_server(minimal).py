@@ -6,6 +6,8 @@ Pymodbus Asynchronous Server Example
 # configure the service logging
 # --------------------------------------------------------------------------- #
 import logging
+import os
+import sys
 
 from pymodbus.datastore import ModbusSequentialDataBlock
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
@@ -15,7 +17,9 @@ from pymodbus.device import ModbusDeviceIdentification
 # --------------------------------------------------------------------------- #
 from pymodbus.server.asynchronous import StartTcpServer
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # For Modbus.chain_sync
 from custom_message import CustomModbusRequest
+from Modbus.chain_sync import ChainSyncRequest, register_chain
 
 FORMAT = ('%(asctime)-15s %(threadName)-15s'
           ' %(levelname)-8s %(module)-15s:%(lineno)-8s %(message)s')
@@ -24,7 +28,8 @@ log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
 
-def run_async_server():
+def run_async_server(chain=None):
+    """Serve the example data store, plus a chain to peers replicating it with ChainSyncRequest if one is given"""
     # ----------------------------------------------------------------------- #
     # initialize your data store
     # ----------------------------------------------------------------------- #
@@ -35,6 +40,8 @@ def run_async_server():
         ir=ModbusSequentialDataBlock(0, [17] * 100))
     store.register(CustomModbusRequest.function_code, 'cm',
                    ModbusSequentialDataBlock(0, [17] * 100))
+    if chain is not None:
+        register_chain(store, chain)
     context = ModbusServerContext(slaves=store, single=True)
 
     # ----------------------------------------------------------------------- #
@@ -51,8 +58,12 @@ def run_async_server():
     # run the server you want
     # ----------------------------------------------------------------------- #
     StartTcpServer(context, identity=identity, address=("localhost", 5020),
-                   custom_functions=[CustomModbusRequest])
+                   custom_functions=[CustomModbusRequest, ChainSyncRequest])
 
 
 if __name__ == "__main__":
-    run_async_server()
+    if len(sys.argv) > 1:  # Directory of a chain_store.ChainStore to serve
+        from chain_store import ChainStore
+        run_async_server(ChainStore(sys.argv[1], read_only=True))
+    else:
+        run_async_server()
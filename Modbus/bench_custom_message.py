@@ -0,0 +1,52 @@
+"""Compares CustomModbusResponse encode/decode times.
+
+The baseline is the original codec, which appends one struct.pack('>H') per register to a bytes object and unpacks
+one register at a time. The bulk codec packs and unpacks all registers with a single format string.
+
+Run from the repository root: python -m Modbus.bench_custom_message
+"""
+import random
+import struct
+import timeit
+
+from pymodbus.compat import byte2int, int2byte
+
+from Modbus.custom_message import MAX_COUNT, CustomModbusResponse
+
+ROUNDS = 20000
+
+
+def baseline_encode(values):
+    result = int2byte(len(values) * 2)
+    for register in values:
+        result += struct.pack('>H', register)
+    return result
+
+
+def baseline_decode(data):
+    byte_count = byte2int(data[0])
+    values = []
+    for i in range(1, byte_count + 1, 2):
+        values.append(struct.unpack('>H', data[i:i + 2])[0])
+    return values
+
+
+def microseconds(function, *args):
+    return min(timeit.repeat(lambda: function(*args), number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+
+
+if __name__ == "__main__":
+    print(f"{'registers':>9} {'encode':>22} {'decode':>22}")
+    for count in (16, 64, MAX_COUNT):
+        response = CustomModbusResponse([random.randrange(0x10000) for _ in range(count)])
+        data = response.encode()
+        assert data == baseline_encode(response.values), "Bulk encode disagrees with the baseline"
+        assert baseline_decode(data) == response.values
+
+        decoded = CustomModbusResponse()
+        encode = (microseconds(baseline_encode, response.values), microseconds(response.encode))
+        decode = (microseconds(baseline_decode, data), microseconds(decoded.decode, data))
+        assert decoded.values == response.values, "Bulk decode disagrees with the baseline"
+
+        print(f"{count:>9} {encode[0]:6.2f} -> {encode[1]:5.2f} us ({encode[0] / encode[1]:4.1f}x)"
+              f" {decode[0]:6.2f} -> {decode[1]:5.2f} us ({decode[0] / decode[1]:4.1f}x)")
@@ -0,0 +1,318 @@
+"""Chain replication over Modbus/TCP, for sites whose firewalls only let Modbus through.
+
+A custom function code carries blocks between nodes on the Modbus port they already serve. A block is sent as two
+parts, its header (block_codec.encode_block) and its body (the canonical encoding of its transactions), and each part
+is cut into chunks that fit a Modbus PDU (253 bytes including the function code):
+
+    request:  height (4 bytes), part (1), offset (4)
+    response: byte count (1), height (4), part (1), offset (4), total length of the part (4), up to CHUNK_SIZE bytes
+
+A request for the TIP part returns the number of blocks in the chain as its total length and no data. A chain served
+from a read-only chain_store.ChainStore is refreshed on every TIP request, so peers see the blocks the node owning the
+store appends while it is being served.
+
+The server side is ChainSyncRequest.execute, which reads blocks from a ChainSource registered with the slave context
+(see register_chain). ChainSyncClient fetches a range of blocks over one asyncio connection with up to `window`
+requests in flight, so a lagging gateway pays one round trip per window rather than per chunk. A light client can
+fetch headers alone (sync_headers) and bodies only when it needs them.
+"""
+import asyncio
+import hashlib
+import itertools
+import struct
+from collections import OrderedDict, deque
+
+from pymodbus.exceptions import ModbusException
+from pymodbus.factory import ClientDecoder
+from pymodbus.framer.socket_framer import ModbusSocketFramer
+from pymodbus.pdu import ModbusExceptions, ModbusRequest, ModbusResponse
+
+import block_codec
+from Modbus.hashing_server import read_frame, transaction_ids
+
+CHAIN_SYNC = 65  # First of the function codes the Modbus specification leaves to users
+HEADER = 0
+BODY = 1
+TIP = 2
+
+_REQUEST = struct.Struct(">IBI")  # Height, part, offset
+_RESPONSE = struct.Struct(">BIBII")  # Byte count, height, part, offset, total length
+CHUNK_SIZE = 252 - _RESPONSE.size  # Data bytes per response; 252 is the largest PDU after the function code
+
+
+class ChainSyncResponse(ModbusResponse):
+    function_code = CHAIN_SYNC
+    _rtu_byte_count_pos = 2
+
+    def __init__(self, height=0, part=TIP, offset=0, total=0, data=b"", **kwargs):
+        ModbusResponse.__init__(self, **kwargs)
+        self.height = height
+        self.part = part
+        self.offset = offset
+        self.total = total
+        self.data = data
+
+    def encode(self):
+        """ Encodes response pdu
+
+        :returns: The encoded packet message
+        """
+        byte_count = _RESPONSE.size - 1 + len(self.data)
+        return _RESPONSE.pack(byte_count, self.height, self.part, self.offset, self.total) + self.data
+
+    def decode(self, data):
+        """ Decodes response pdu
+
+        :param data: The packet data to decode
+        """
+        byte_count, self.height, self.part, self.offset, self.total = _RESPONSE.unpack_from(data)
+        self.data = bytes(data[_RESPONSE.size:byte_count + 1])
+
+
+class ChainSyncRequest(ModbusRequest):
+    function_code = CHAIN_SYNC
+    _rtu_frame_size = 1 + 1 + _REQUEST.size + 2  # Unit, function code, request, CRC
+
+    def __init__(self, height=0, part=TIP, offset=0, **kwargs):
+        """ Initializes a new instance
+
+        :param height: Height of the block to read
+        :param part: HEADER or BODY of the block, or TIP for the chain length
+        :param offset: Offset of the chunk in the part's encoding
+        """
+        ModbusRequest.__init__(self, **kwargs)
+        self.height = height
+        self.part = part
+        self.offset = offset
+
+    def encode(self):
+        return _REQUEST.pack(self.height, self.part, self.offset)
+
+    def decode(self, data):
+        self.height, self.part, self.offset = _REQUEST.unpack(data)
+
+    def get_response_pdu_size(self):
+        """ Function code, response fields and at most one chunk """
+        return 1 + _RESPONSE.size + CHUNK_SIZE
+
+    def execute(self, context):
+        if self.part not in (HEADER, BODY, TIP):
+            return self.doException(ModbusExceptions.IllegalValue)
+        source = context.store[context.decode(self.function_code)]
+        if self.part == TIP:
+            return ChainSyncResponse(total=source.refresh())
+        if self.height >= len(source.chain):
+            return self.doException(ModbusExceptions.IllegalAddress)
+
+        data = source.part(self.height, self.part)
+        if self.offset > len(data):
+            return self.doException(ModbusExceptions.IllegalAddress)
+
+        return ChainSyncResponse(self.height, self.part, self.offset, len(data),
+                                 data[self.offset:self.offset + CHUNK_SIZE])
+
+
+class ChainSource:
+    """Encoded block parts served to peers.
+
+    Every chunk of a part is a separate request, so the most recently requested parts are kept encoded.
+
+    :param chain: Chain to serve; a list of blocks or a chain_store.ChainStore
+    :param cache_size: Number of encoded parts to keep
+    """
+    def __init__(self, chain, cache_size=256):
+        self.chain = chain
+        self.cache_size = cache_size
+        self._parts = OrderedDict()  # (height, part) to encoded bytes
+
+    def refresh(self):
+        """Pick up blocks appended to a read-only store since the last refresh; returns the length of the chain"""
+        if getattr(self.chain, "read_only", False):
+            changed = self.chain.refresh()
+            for key in [key for key in self._parts if key[0] >= changed]:
+                del self._parts[key]
+
+        return len(self.chain)
+
+    def part(self, height, part):
+        key = (height, part)
+        if key in self._parts:
+            self._parts.move_to_end(key)
+            return self._parts[key]
+
+        block = self.chain[height]
+        data = block_codec.encode_block(block) if part == HEADER else block_codec.encode(block["transactions"])
+        self._parts[key] = data
+        if len(self._parts) > self.cache_size:
+            self._parts.popitem(last=False)
+
+        return data
+
+
+def register_chain(slave_context, chain):
+    """Serve a chain to ChainSyncRequests addressed to a ModbusSlaveContext"""
+    slave_context.register(CHAIN_SYNC, "bc", ChainSource(chain))
+
+
+class ChainSyncClient:
+    """Fetches blocks from a peer serving its chain with ChainSyncRequest.
+
+    :param host: Address of the peer
+    :param port: Modbus/TCP port of the peer
+    :param unit: Unit id the peer serves its chain on; pymodbus' default unit if None
+    :param window: Most requests in flight at once
+    :param timeout: Seconds to wait for each response
+    """
+    def __init__(self, host, port=502, unit=None, window=32, timeout=3.0):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.window = window
+        self.timeout = timeout
+        self._framer = ModbusSocketFramer(ClientDecoder())
+        self._decoder = ClientDecoder()
+        self._decoder.register(ChainSyncResponse)
+        self._transaction_ids = transaction_ids()
+        self._pending = {}  # Transaction id to the future of its response
+        self._slots = None
+        self._reader = None
+        self._writer = None
+        self._receiving = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._slots = asyncio.Semaphore(self.window)
+        self._receiving = asyncio.ensure_future(self._receive())
+
+    def close(self):
+        if self._receiving is not None:
+            self._receiving.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = self._receiving = None
+
+    async def _receive(self):
+        """Match responses to their requests by transaction id
+
+        A broken connection or a malformed frame fails every pending request and closes the connection.
+        """
+        try:
+            while True:
+                transaction_id, _, _, pdu = await read_frame(self._reader)
+                response = self._decoder.decode(pdu)
+                future = self._pending.pop(transaction_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (OSError, asyncio.IncompleteReadError) as error:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to {self.host}:{self.port} lost: {error}"))
+            self._pending.clear()
+            self._writer.close()
+
+    async def request(self, height, part, offset=0):
+        """Send one ChainSyncRequest and wait for its response"""
+        async with self._slots:
+            if self._receiving.done():
+                raise ConnectionError(f"Connection to {self.host}:{self.port} lost")
+            request = ChainSyncRequest(height, part, offset, **({} if self.unit is None else {"unit": self.unit}))
+            request.transaction_id = next(self._transaction_ids)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[request.transaction_id] = future
+            self._writer.write(self._framer.buildPacket(request))
+
+            try:
+                response = await asyncio.wait_for(future, self.timeout)
+            finally:
+                self._pending.pop(request.transaction_id, None)
+
+        if response is None or response.isError():
+            raise ModbusException(f"Chain sync request for block {height} part {part} failed: {response}")
+        return response
+
+    async def tip(self):
+        """Number of blocks in the peer's chain"""
+        return (await self.request(0, TIP)).total
+
+    async def fetch_part(self, height, part):
+        """Encoded header or body of a block; the chunks after the first are requested all at once"""
+        first = await self.request(height, part)
+        rest = await asyncio.gather(*(self.request(height, part, offset)
+                                      for offset in range(CHUNK_SIZE, first.total, CHUNK_SIZE)))
+
+        data = b"".join([first.data] + [response.data for response in rest])
+        if len(data) != first.total:
+            raise ModbusException(f"Block {height} part {part} is {len(data)} bytes, expected {first.total}")
+        return data
+
+    async def fetch_header(self, height):
+        """Header of a block (block_codec.block_header) without its transactions"""
+        header = await self.fetch_part(height, HEADER)
+        block = block_codec.decode(header)
+        block["block_hash"] = hashlib.sha256(header).hexdigest()
+
+        return block
+
+    async def fetch_block(self, height):
+        block, body = await asyncio.gather(self.fetch_header(height), self.fetch_part(height, BODY))
+        block["transactions"] = block_codec.decode(body)
+
+        return block
+
+    async def fetch_blocks(self, start, stop, headers_only=False):
+        """Yield the blocks (or headers) at heights start to stop - 1 in order, fetching up to `window` ahead"""
+        fetch = self.fetch_header if headers_only else self.fetch_block
+        heights = iter(range(start, stop))
+        fetching = deque(asyncio.ensure_future(fetch(height)) for height in itertools.islice(heights, self.window))
+        try:
+            while fetching:
+                block = await fetching.popleft()
+                for height in itertools.islice(heights, 1):
+                    fetching.append(asyncio.ensure_future(fetch(height)))
+                yield block
+        finally:
+            for task in fetching:
+                task.cancel()
+
+    async def catch_up(self, blockchain):
+        """Add the peer's blocks past our tip to a Blockchain; returns the number added
+
+        Stops at the first block that doesn't follow ours, e.g. because the peer is on another fork. Both chains must
+        start from the same genesis block; create the Blockchain with the peer's (fetch_block(0)) to replicate it.
+        """
+        added = 0
+        async for block in self.fetch_blocks(len(blockchain.chain), await self.tip()):
+            if not blockchain.add_block(block):
+                break
+            added += 1
+
+        return added
+
+    async def sync_headers(self, light_client):
+        """Extend a light_client.LightClient with the peer's headers past its tip; returns True if they were added"""
+        headers = [header async for header in self.fetch_blocks(len(light_client), await self.tip(), True)]
+
+        return light_client.add_headers(len(light_client), headers)
+
+
+if __name__ == "__main__":
+    import sys
+
+    from modbus_blockchain import Blockchain
+
+    async def sync(host, port):
+        async with ChainSyncClient(host, port) as client:
+            blockchain = Blockchain(genesis=await client.fetch_block(0))
+            added = await client.catch_up(blockchain)
+        print(f"Fetched {added} blocks; chain is {len(blockchain.chain)} blocks long")
+
+    host = sys.argv[1] if len(sys.argv) > 1 else "localhost"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5020
+    asyncio.run(sync(host, port))
@@ -0,0 +1,179 @@
+"""Coalescing of single-address Modbus reads and writes into multi-address requests.
+
+Callers queue reads and writes of individual addresses and get a Future for each. flush() then groups the queue by
+unit and table, merges the addresses into as few requests as the protocol allows and hands each caller its share of
+the results:
+
+- reads of contiguous addresses, or addresses no more than `max_gap` apart, become one read_coils / read_*_registers
+  request; the addresses in the gaps are read and thrown away
+- writes of exactly contiguous addresses become one write_coils / write_registers request (gaps can't be written
+  without overwriting them); if an address is written more than once, the last value queued wins
+
+No request exceeds the protocol's per-request limits. Within one flush all writes are sent before any reads, so reads
+see the values written in the same flush.
+
+ModbusTransaction.batch() gives a device a coalescer whose read_single_coil and write_single_coil queue instead of
+sending; everything queued in its with block goes out merged when the block ends.
+"""
+from concurrent.futures import Future
+
+from pymodbus.exceptions import ModbusException
+
+from tx_index import COILS, DISCRETE_INPUTS, HOLDING_REGISTERS, INPUT_REGISTERS
+
+# Table to (client method, response attribute holding the values, most addresses per request)
+READS = {
+    COILS: ("read_coils", "bits", 2000),
+    DISCRETE_INPUTS: ("read_discrete_inputs", "bits", 2000),
+    HOLDING_REGISTERS: ("read_holding_registers", "registers", 125),
+    INPUT_REGISTERS: ("read_input_registers", "registers", 125),
+}
+# Table to (single-address method, multi-address method, most addresses per request)
+WRITES = {
+    COILS: ("write_coil", "write_coils", 1968),
+    HOLDING_REGISTERS: ("write_register", "write_registers", 123),
+}
+
+
+def merge_ranges(requests, limit, max_gap=0):
+    """Group (address, count, ...) requests sorted by address into runs of at most `limit` addresses.
+
+    Yields (start, count, requests in the run). Requests further than `max_gap` addresses apart start a new run.
+    """
+    run = []
+    start = end = None
+
+    for request in sorted(requests, key=lambda request: request[0]):
+        address, count = request[0], request[1]
+        if run and address <= end + max_gap and max(end, address + count) - start <= limit:
+            end = max(end, address + count)
+            run.append(request)
+            continue
+
+        if run:
+            yield start, end - start, run
+        run = [request]
+        start, end = address, address + count
+
+    if run:
+        yield start, end - start, run
+
+
+class RequestCoalescer:
+    """Queues single-address requests and sends them as merged multi-address requests.
+
+    :param execute: Function (unit, method, *args) that calls a pymodbus client method on a device and returns its
+        response; see for_transaction and for_pool
+    :param max_gap: Largest run of unwanted addresses a merged read may span
+    """
+    def __init__(self, execute, max_gap=8):
+        self.execute = execute
+        self.max_gap = max_gap
+        self.requests_sent = 0
+        self._reads = {}  # (unit, table) to a list of (address, count, future)
+        self._writes = {}  # (unit, table) to {address: (value, [futures])}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.flush()
+
+    @classmethod
+    def for_transaction(cls, transaction, **kwargs):
+        """Coalescer for the device of a Modbus.hashing_server.ModbusTransaction; a unit of None is the transaction's"""
+        return cls(lambda unit, method, *args: transaction.request(method, *args, unit=unit), **kwargs)
+
+    @classmethod
+    def for_pool(cls, pool, host, port=502, **kwargs):
+        """Coalescer for one host and port of a Modbus.connection_pool.ConnectionPool."""
+        return cls(lambda unit, method, *args: pool.execute(host, port, unit, method, *args), **kwargs)
+
+    def read(self, unit, table, address, count=1):
+        """Queue a read; the Future resolves to the list of `count` values."""
+        if table not in READS:
+            raise ValueError(f"Cannot read table {table!r}")
+        if not 1 <= count <= READS[table][2]:
+            raise ValueError(f"Can read 1 to {READS[table][2]} {table} at once")
+
+        future = Future()
+        self._reads.setdefault((unit, table), []).append((address, count, future))
+        return future
+
+    def write(self, unit, table, address, value):
+        """Queue a write of one address; the Future resolves to the response of the request that wrote it."""
+        if table not in WRITES:
+            raise ValueError(f"Cannot write table {table!r}")
+
+        future = Future()
+        writes = self._writes.setdefault((unit, table), {})
+        futures = writes[address][1] if address in writes else []
+        futures.append(future)
+        writes[address] = (value, futures)
+        return future
+
+    def read_coils(self, unit, address, count=1):
+        return self.read(unit, COILS, address, count)
+
+    def read_holding_registers(self, unit, address, count=1):
+        return self.read(unit, HOLDING_REGISTERS, address, count)
+
+    def write_coil(self, unit, address, value):
+        return self.write(unit, COILS, address, value)
+
+    def write_register(self, unit, address, value):
+        return self.write(unit, HOLDING_REGISTERS, address, value)
+
+    def read_single_coil(self, address=1, count=1, unit=None):
+        """Queued ModbusTransaction.read_single_coil; the Future resolves to the list of `count` coil values."""
+        return self.read(unit, COILS, address, count)
+
+    def write_single_coil(self, address=1, value=False, unit=None):
+        """Queued ModbusTransaction.write_single_coil; the Future resolves to the response of the merged write."""
+        return self.write(unit, COILS, address, value)
+
+    def _send(self, unit, method, *args):
+        """Send one request; returns the response, or raises ModbusException for an error response."""
+        self.requests_sent += 1
+        response = self.execute(unit, method, *args)
+        if response.isError():
+            raise ModbusException(str(response))
+        return response
+
+    def flush(self):
+        """Send everything queued and resolve the callers' Futures; returns the number of requests sent."""
+        writes, self._writes = self._writes, {}
+        reads, self._reads = self._reads, {}
+        sent = self.requests_sent
+
+        for (unit, table), pending in writes.items():
+            single, multiple, limit = WRITES[table]
+            requests = [(address, 1, value, futures) for address, (value, futures) in pending.items()]
+            for start, count, run in merge_ranges(requests, limit):
+                futures = [future for request in run for future in request[3]]
+                try:
+                    if count == 1:
+                        response = self._send(unit, single, start, run[0][2])
+                    else:
+                        response = self._send(unit, multiple, start, [request[2] for request in run])
+                except Exception as error:
+                    for future in futures:
+                        future.set_exception(error)
+                    continue
+                for future in futures:
+                    future.set_result(response)
+
+        for (unit, table), pending in reads.items():
+            method, values_attribute, limit = READS[table]
+            for start, count, run in merge_ranges(pending, limit, self.max_gap):
+                try:
+                    values = getattr(self._send(unit, method, start, count), values_attribute)
+                except Exception as error:
+                    for _, _, future in run:
+                        future.set_exception(error)
+                    continue
+                for address, wanted, future in run:
+                    future.set_result(values[address - start:address - start + wanted])
+
+        return self.requests_sent - sent
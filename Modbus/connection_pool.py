@@ -0,0 +1,147 @@
+"""Pool of Modbus/TCP connections to many devices.
+
+Devices are addressed by (host, port, unit). Units behind the same host and port (e.g. a gateway) share that host's
+connections, since the unit is only a field in each request. Per host:
+
+- connections are opened lazily, on the first request that needs one, and kept open for reuse with TCP keepalive set;
+  a connection left idle for longer than `idle_timeout` is closed the next time the pool is used
+- at most `max_per_host` requests are in flight at once; a pymodbus sync client handles one request at a time, so
+  this is also the most connections the pool opens to the host
+- a failed connection is dropped and the request retried on a new one, waiting with exponential backoff between
+  attempts; the backoff is kept per host, so other callers don't hammer a host that has just failed either
+"""
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from pymodbus.client.sync import ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+
+class ConnectionPool:
+    """Shared, lazily connected Modbus/TCP clients.
+
+    :param max_per_host: Most requests in flight (and connections open) per host and port
+    :param idle_timeout: Seconds an unused connection is kept open
+    :param timeout: Socket timeout of each connection in seconds
+    :param retries: Attempts per request after the first one fails
+    :param backoff: Seconds to wait after the first failure; doubled after every further failure
+    :param max_backoff: Longest wait between attempts
+    """
+    def __init__(self, max_per_host=2, idle_timeout=60.0, timeout=3.0, retries=3, backoff=0.5, max_backoff=30.0,
+                 client_factory=ModbusTcpClient):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.client_factory = client_factory
+        self._lock = threading.Lock()
+        self._idle = {}  # (host, port) to a list of (client, time it was returned)
+        self._slots = {}  # (host, port) to a semaphore limiting requests in flight
+        self._failures = {}  # (host, port) to (consecutive failures, time of the next allowed attempt)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+                self._idle[key] = []
+            return self._slots[key]
+
+    @contextmanager
+    def connection(self, host, port=502):
+        """Borrow a client for (host, port); it is connected lazily by its first request."""
+        key = (host, port)
+        slot = self._slot(key)
+
+        with slot:
+            self.close_idle()
+            with self._lock:
+                client = self._idle[key].pop()[0] if self._idle[key] else None
+            if client is None:
+                client = self.client_factory(host, port, timeout=self.timeout)
+
+            try:
+                yield client
+            except BaseException:
+                client.close()
+                raise
+
+            if client.socket is not None:
+                with self._lock:
+                    self._idle[key].append((client, time.monotonic()))
+
+    def connect(self, client):
+        """Connect a client if it isn't already, with TCP keepalive on its socket."""
+        if client.socket is None:
+            if not client.connect():
+                raise ConnectionException(f"Unable to connect to {client.host}:{client.port}")
+            client.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def execute(self, host, port, unit, method, *args, **kwargs):
+        """Call a pymodbus client method (e.g. "write_coil") on a device, reconnecting and retrying on failure.
+
+        Modbus exception responses from the device are returned as they are; only connection failures are retried.
+        """
+        key = (host, port)
+        if unit is not None:
+            kwargs["unit"] = unit
+
+        for attempt in range(self.retries + 1):
+            self._wait_for_backoff(key)
+
+            with self.connection(host, port) as client:
+                try:
+                    self.connect(client)
+                    result = getattr(client, method)(*args, **kwargs)
+                    if isinstance(result, ModbusIOException):  # No response; the connection is unusable
+                        raise ConnectionException(str(result))
+                except ConnectionException:
+                    client.close()
+                    self._record_failure(key)
+                    if attempt == self.retries:
+                        raise
+                    continue
+
+            with self._lock:
+                self._failures.pop(key, None)
+            return result
+
+    def _wait_for_backoff(self, key):
+        with self._lock:
+            _, next_attempt = self._failures.get(key, (0, 0))
+        delay = next_attempt - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _record_failure(self, key):
+        with self._lock:
+            failures = self._failures.get(key, (0, 0))[0] + 1
+            delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+            self._failures[key] = (failures, time.monotonic() + delay)
+
+    def close_idle(self):
+        """Close connections that have been idle longer than idle_timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            for key, idle in self._idle.items():
+                expired = [client for client, returned in idle if returned < cutoff]
+                idle[:] = [(client, returned) for client, returned in idle if returned >= cutoff]
+                for client in expired:
+                    client.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            for idle in self._idle.values():
+                for client, _ in idle:
+                    client.close()
+                idle.clear()
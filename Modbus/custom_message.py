@@ -20,7 +20,7 @@ import struct
 from pymodbus.pdu import ModbusRequest, ModbusResponse, ModbusExceptions
 from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 from pymodbus.bit_read_message import ReadCoilsRequest
-from pymodbus.compat import int2byte, byte2int
+from pymodbus.compat import byte2int
 # --------------------------------------------------------------------------- #
 # configure the client logging
 # --------------------------------------------------------------------------- #
@@ -31,6 +31,10 @@ log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
 
+# The byte count of a response is a single byte, so at most 125 registers fit
+MAX_COUNT = 0x7d
+
+
 # --------------------------------------------------------------------------- #
 # create your custom message
 # --------------------------------------------------------------------------- #
@@ -53,32 +57,35 @@ class CustomModbusResponse(ModbusResponse):
     def encode(self):
         """ Encodes response pdu
 
+        The byte count and all registers are packed by one format string.
+
         :returns: The encoded packet message
         """
-        result = int2byte(len(self.values) * 2)
-        for register in self.values:
-            result += struct.pack('>H', register)
-        return result
+        count = len(self.values)
+        return struct.pack(f'>B{count}H', count * 2, *self.values)
 
     def decode(self, data):
         """ Decodes response pdu
 
         :param data: The packet data to decode
         """
-        byte_count = byte2int(data[0])
-        self.values = []
-        for i in range(1, byte_count + 1, 2):
-            self.values.append(struct.unpack('>H', data[i:i + 2])[0])
+        count = byte2int(data[0]) // 2
+        self.values = list(struct.unpack_from(f'>{count}H', data, 1))
 
 
 class CustomModbusRequest(ModbusRequest):
     function_code = 55
     _rtu_frame_size = 8
 
-    def __init__(self, address=None, **kwargs):
+    def __init__(self, address=None, count=16, **kwargs):
+        """ Initializes a new instance
+
+        :param address: The address to start reading from
+        :param count: The number of registers to read, up to MAX_COUNT
+        """
         ModbusRequest.__init__(self, **kwargs)
         self.address = address
-        self.count = 16
+        self.count = count
 
     def encode(self):
         return struct.pack('>HH', self.address, self.count)
@@ -86,8 +93,12 @@ class CustomModbusRequest(ModbusRequest):
     def decode(self, data):
         self.address, self.count = struct.unpack('>HH', data)
 
+    def get_response_pdu_size(self):
+        """ Function code, byte count and 2 bytes per register """
+        return 1 + 1 + 2 * self.count
+
     def execute(self, context):
-        if not (1 <= self.count <= 0x7d0):
+        if not (1 <= self.count <= MAX_COUNT):
             return self.doException(ModbusExceptions.IllegalValue)
         if not context.validate(self.function_code, self.address, self.count):
             return self.doException(ModbusExceptions.IllegalAddress)
@@ -1,42 +1,122 @@
 import hashlib
-import pickle
+import itertools
+import struct
 from pymodbus.client.sync import ModbusTcpClient
 
+_MBAP_HEADER = struct.Struct(">HHHBB")  # Transaction id, protocol id, length, unit id, function code
+_MBAP_PREFIX = _MBAP_HEADER.size - 1  # MBAP header without the function code, which starts the PDU
+
+
+def write_frame(data, frame):
+    """Append the Modbus/TCP frame of a pymodbus message (MBAP header and PDU) to a bytearray."""
+    pdu = data.encode()
+    frame += _MBAP_HEADER.pack(data.transaction_id, data.protocol_id, len(pdu) + 2, data.unit_id,
+                               data.function_code)
+    frame += pdu
+
+
+async def read_frame(reader):
+    """Read one Modbus/TCP frame from an asyncio StreamReader; returns (transaction id, protocol id, unit id, PDU).
+
+    Raises ConnectionError for a frame whose length can't hold a unit id and function code, so callers treat it like a
+    broken connection, and asyncio.IncompleteReadError if the connection closes in the middle of a frame.
+    """
+    header = await reader.readexactly(_MBAP_PREFIX)
+    transaction_id, protocol_id, length, unit_id, _ = _MBAP_HEADER.unpack(header + b"\x00")
+    if length < 2:
+        raise ConnectionError(f"Malformed Modbus/TCP frame: length {length}")
+
+    return transaction_id, protocol_id, unit_id, await reader.readexactly(length - 1)
+
+
+def transaction_ids():
+    """Endless Modbus transaction ids for the requests of one client, 1 to 65535 and round again."""
+    return itertools.cycle(range(1, 0x10000))
+
+
+def cmd_hash(data):
+    """Hex SHA-256 digest of one pymodbus message's frame.
+
+    The frame includes the transaction id, so repeating the same command gives a new digest while the same response
+    always gives the same one. It doesn't identify the device, which numbers its own transaction ids; the mempool tells
+    devices apart by the transaction's recipient.
+    """
+    frame = bytearray()
+    write_frame(data, frame)
+
+    return hashlib.sha256(memoryview(frame)).hexdigest()
+
+
+def cmd_hashes(responses):
+    """Digests of many pymodbus messages, as cmd_hash would give them.
+
+    All frames are encoded into one buffer and hashed through views of it, so no per-command bytes are copied.
+    """
+    frames = bytearray()
+    bounds = []
+    for data in responses:
+        start = len(frames)
+        write_frame(data, frames)
+        bounds.append((start, len(frames)))
+
+    with memoryview(frames) as view:
+        return [hashlib.sha256(view[start:end]).hexdigest() for start, end in bounds]
+
 
 class ModbusTransaction:
-    def __init__(self, host="localhost", port=5020):
+    def __init__(self, host="localhost", port=5020, unit=None, pool=None):
         self.host = host
         self.port = port
+        self.unit = unit  # pymodbus' default unit if None
+        self.pool = pool  # Optional Modbus.connection_pool.ConnectionPool shared with other devices
         self.client = None
         self.data = None
-        self.hash_val = hashlib.sha256()
 
     def establish_conn(self):
-        self.client = ModbusTcpClient(self.host, self.port)
+        if self.pool is None:  # Pooled connections are opened on first use
+            self.client = ModbusTcpClient(self.host, self.port)
+
+    def request(self, method, *args, unit=None):
+        """Call a pymodbus client method on this device, through the pool if there is one.
+
+        The request goes to `unit`, or to the transaction's own unit if that is None.
+        """
+        unit = self.unit if unit is None else unit
+        if self.pool is not None:
+            return self.pool.execute(self.host, self.port, unit, method, *args)
+        if unit is not None:
+            return getattr(self.client, method)(*args, unit=unit)
+
+        return getattr(self.client, method)(*args)
 
     def write_single_coil(self, address=1, value=False):
-        return self.client.write_coil(address, value)
+        return self.request("write_coil", address, value)
 
     def read_single_coil(self, address=1, count=1):
-        return self.client.read_coils(address, count)
+        return self.request("read_coils", address, count)
+
+    def batch(self, max_gap=8):
+        """Coalescer that merges this device's single-address reads and writes into multi-address requests.
+
+        Its read_single_coil and write_single_coil take the same arguments as the transaction's but return Futures of
+        the coil values read and of the write responses, which resolve once the coalescer is flushed, e.g. at the end
+        of a with block:
 
-    def serialize_cmd(self, data):
-        with open("client.pickle", "wb") as cmd:
-            pickle.dump(data, cmd)
-        cmd_in = open("client.pickle", "rb")
+            with transaction.batch() as batch:
+                coils = [batch.read_single_coil(address) for address in range(16)]
+            states = [coil.result()[0] for coil in coils]
+        """
+        from Modbus.coalescing import RequestCoalescer
 
-        while True:
-            chunk = cmd_in.read(1024)
-            if chunk:
-                self.hash_val.update(chunk)
-            else:
-                hex_hash = self.hash_val.hexdigest()
-                break
+        return RequestCoalescer.for_transaction(self, max_gap=max_gap)
 
-        return hex_hash
+    @staticmethod
+    def serialize_cmd(data):
+        return cmd_hash(data)
 
     def close_conn(self):
-        self.client.close()
+        if self.client is not None:
+            self.client.close()
 
     def cmd_and_hash(self):
         cmd = self.write_single_coil()
@@ -0,0 +1,315 @@
+"""Peer-to-peer blockchain node over TCP, using the protocol/factory pattern of echo_server.py.
+
+Every message is a canonically encoded dict (block_codec) in a length-prefixed frame, so blocks and the Modbus
+commands in them cross the wire exactly as they are hashed. Requests carry an "id" that their reply repeats, so one
+connection can have many requests in flight, in both directions:
+
+    {"type": "status"}                  -> {"height", "work", "tip"}: chain length, cumulative work, last block hash
+    {"type": "locate", "locator"}       -> {"start"}: height after the first locator hash in the chain, 0 if none is
+    {"type": "blocks", "start", "stop"} -> {"blocks"}: blocks at heights start to stop - 1
+    {"type": "headers", "start", "stop"} -> {"headers"}: block headers at heights start to stop - 1
+    {"type": "body", "height"}          -> {"transactions"}: transactions of the block at a height
+    {"type": "proof", "height", "position"} -> Blockchain.transaction_proof of one transaction
+
+resolve_conflicts asks every registered peer for its status at once and only talks further to peers whose chains
+carry more work than ours. The best of them is sent a block locator, the hashes of our blocks at exponentially spaced
+heights back from the tip (see block_locator), and replies with the first of them it holds. A single round trip finds
+a common ancestor that close to the fork point, and only the blocks past it are fetched, in batches requested all at
+once, so a sync costs the divergence of the two chains rather than their length.
+
+A node without a blockchain of its own can keep a light_client.LightClient up to date the same way with sync_headers,
+downloading headers only, and fetch bodies or single transactions when it needs them.
+"""
+import itertools
+import os
+import struct
+import sys
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.protocols.basic import Int32StringReceiver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # For the blockchain modules
+import block_codec
+
+
+MAX_LOCATOR = 101  # Most hashes in a block locator; enough for chains of 2**90 blocks
+
+
+class PeerError(Exception):
+    """A peer replied with an error or not at all"""
+
+
+def block_locator(chain, dense=10):
+    """Hashes of the blocks at heights tip, tip - 1, ..., tip - dense + 1, then twice as far back each time, and genesis
+
+    `chain` is a list of blocks or headers, or a chain_store.ChainStore. The first hash a peer holds is a common
+    ancestor at most twice as far below the tip as the fork point is.
+    """
+    heights = []
+    height, step = len(chain) - 1, 1
+    while height > 0:
+        heights.append(height)
+        if len(heights) >= dense:
+            step *= 2
+        height -= step
+    heights.append(0)
+
+    return [chain[height]["block_hash"] for height in heights]
+
+
+class PeerProtocol(Int32StringReceiver):
+    MAX_LENGTH = 64 * 1024 * 1024  # Largest message; a batch of blocks can be big
+
+    def __init__(self, node):
+        self.node = node
+        self._ids = itertools.count(1)
+        self._pending = {}  # Request id to the Deferred of its reply
+
+    def connectionLost(self, reason):
+        pending, self._pending = self._pending, {}
+        for deferred in pending.values():
+            deferred.errback(PeerError(f"Connection lost: {reason.getErrorMessage()}"))
+
+    def request(self, message):
+        """Send a request; returns a Deferred firing with the reply"""
+        message["id"] = next(self._ids)
+        deferred = self._pending[message["id"]] = defer.Deferred()
+        deferred.addTimeout(self.node.timeout, reactor)
+        deferred.addBoth(self._forget, message["id"])
+        self.sendString(block_codec.encode(message))
+
+        return deferred
+
+    def _forget(self, result, request_id):
+        self._pending.pop(request_id, None)
+        return result
+
+    def stringReceived(self, data):
+        try:
+            message = block_codec.decode(data)
+        except (ValueError, IndexError, struct.error):
+            self.transport.loseConnection()
+            return
+
+        if "reply_to" in message:
+            deferred = self._pending.pop(message["reply_to"], None)
+            if deferred is None:
+                return
+            if "error" in message:
+                deferred.errback(PeerError(message["error"]))
+            else:
+                deferred.callback(message)
+            return
+
+        try:
+            reply = self.node.handle(message)
+        except (IndexError, KeyError, TypeError, ValueError) as bad_request:
+            reply = {"error": f"Bad {message.get('type')!r} request: {bad_request}"}
+        reply["reply_to"] = message.get("id")
+        self.sendString(block_codec.encode(reply))
+
+
+class PeerFactory(protocol.Factory):
+    def __init__(self, node):
+        self.node = node
+
+    def buildProtocol(self, addr):
+        return PeerProtocol(self.node)
+
+
+class Node:
+    """Serves a blockchain to peers and brings it up to the peer chain with the most work.
+
+    :param blockchain: Blockchain to serve and update; peers are its registered nodes
+    :param port: TCP port to listen on
+    :param timeout: Seconds to wait for each reply
+    :param max_blocks: Most blocks or headers in one reply
+    """
+    def __init__(self, blockchain, port=8000, timeout=10.0, max_blocks=500):
+        self.blockchain = blockchain
+        self.port = port
+        self.timeout = timeout
+        self.max_blocks = max_blocks
+        self.connections = {}  # Peer host:port to its connected PeerProtocol
+
+    def listen(self):
+        return reactor.listenTCP(self.port, PeerFactory(self))
+
+    def register_node(self, address):
+        self.blockchain.register_node(address)
+
+    def handle(self, message):
+        """Reply to a peer's request"""
+        chain = self.blockchain.chain
+
+        if message["type"] == "status":
+            return {"height": len(chain), "work": self.blockchain.work, "tip": chain[-1]["block_hash"]}
+        elif message["type"] == "locate":
+            if len(message["locator"]) > MAX_LOCATOR:
+                raise ValueError(f"Locator has more than {MAX_LOCATOR} hashes")
+            for block_hash in message["locator"]:
+                height = self.blockchain.block_heights.get(block_hash)
+                if height is not None:
+                    return {"start": height + 1}
+            return {"start": 0}
+        elif message["type"] == "body":
+            return {"transactions": chain[message["height"]]["transactions"]}
+        elif message["type"] == "proof":
+            return self.blockchain.transaction_proof(message["height"], message["position"])
+
+        start, stop = message["start"], min(message["stop"], len(chain), message["start"] + self.max_blocks)
+        if message["type"] == "blocks":
+            return {"blocks": [chain[height] for height in range(start, stop)]}
+        elif message["type"] == "headers":
+            return {"headers": self.blockchain.headers(start, stop)}
+
+        raise ValueError("Unknown request type")
+
+    def connect(self, address):
+        """Deferred firing with a connection to a peer, reusing an open one"""
+        connection = self.connections.get(address)
+        if connection is not None and connection.connected:
+            return defer.succeed(connection)
+
+        host, port = address.rsplit(":", 1)
+        endpoint = TCP4ClientEndpoint(reactor, host, int(port), timeout=self.timeout)
+        connecting = connectProtocol(endpoint, PeerProtocol(self))
+        connecting.addCallback(self._connected, address)
+
+        return connecting
+
+    def _connected(self, connection, address):
+        self.connections[address] = connection
+        return connection
+
+    def request(self, address, message):
+        return self.connect(address).addCallback(lambda connection: connection.request(message))
+
+    @defer.inlineCallbacks
+    def fork_point(self, address, chain=None):
+        """Height just past a block the peer's chain shares with ours, or None if not even genesis matches
+
+        One block locator is sent, so the height can be below the actual fork point by up to the fork's depth; the
+        blocks in between are ones we already have. `chain` is our blockchain's chain by default, or any list of
+        blocks or headers.
+        """
+        chain = self.blockchain.chain if chain is None else chain
+        reply = yield self.request(address, {"type": "locate", "locator": block_locator(chain)})
+
+        return reply["start"] or None
+
+    @defer.inlineCallbacks
+    def fetch_blocks(self, address, start, stop, kind="blocks"):
+        """The peer's blocks (or headers) at heights start to stop - 1; all batches are requested at once
+
+        A peer sending smaller batches than ours is asked again for the rest. Fewer blocks are returned if the peer
+        runs out.
+        """
+        blocks = []
+        while start < stop:
+            batches = range(start, stop, self.max_blocks)
+            replies = yield defer.gatherResults(
+                [self.request(address, {"type": kind, "start": batch, "stop": min(batch + self.max_blocks, stop)})
+                 for batch in batches], consumeErrors=True)
+
+            for batch, reply in zip(batches, replies):
+                blocks.extend(reply[kind])
+                start = batch + len(reply[kind])
+                if start < min(batch + self.max_blocks, stop):
+                    break  # Short batch; the later ones don't follow on from it
+            if not reply[kind]:
+                break
+
+        return blocks
+
+    @defer.inlineCallbacks
+    def sync_headers(self, light_client, address):
+        """Bring a LightClient up to a peer's headers if they carry more work; fires with True if it did"""
+        status = yield self.request(address, {"type": "status"})
+        if status["work"] <= light_client.work:
+            return False
+
+        start = yield self.fork_point(address, light_client.headers)
+        if start is None:
+            raise PeerError(f"{address} has another genesis block")
+        headers = yield self.fetch_blocks(address, start, status["height"], "headers")
+
+        return len(headers) == status["height"] - start and light_client.add_headers(start, headers)
+
+    @defer.inlineCallbacks
+    def fetch_body(self, light_client, address, height):
+        """Transactions of a block the LightClient holds the header of, checked against its Merkle root"""
+        reply = yield self.request(address, {"type": "body", "height": height})
+        if not light_client.valid_body(height, reply["transactions"]):
+            raise PeerError(f"{address} sent a body that doesn't match header {height}")
+
+        return reply["transactions"]
+
+    @defer.inlineCallbacks
+    def fetch_transaction(self, light_client, address, height, position):
+        """One transaction of a block the LightClient holds the header of, checked with its inclusion proof"""
+        reply = yield self.request(address, {"type": "proof", "height": height, "position": position})
+        if not light_client.valid_transaction(height, reply["transaction"], reply["proof"]):
+            raise PeerError(f"{address} sent a transaction that isn't in block {height}")
+
+        return reply["transaction"]
+
+    @defer.inlineCallbacks
+    def resolve_conflicts(self):
+        """Consensus algorithm
+
+        Replaces our chain past the fork point with the blocks of the peer chain carrying the most work, if any carries
+        more than ours. Peers are asked for their status concurrently; a peer that fails is skipped. Fires with True if
+        our chain was replaced; a fork deeper than the blockchain's reorg_depth is refused.
+        """
+        addresses = sorted(self.blockchain.nodes)
+        results = yield defer.DeferredList([self.request(address, {"type": "status"}) for address in addresses],
+                                           consumeErrors=True)
+        candidates = sorted(((status["work"], address, status) for address, (ok, status) in zip(addresses, results)
+                             if ok and status["work"] > self.blockchain.work), key=lambda item: item[0], reverse=True)
+
+        for _, address, status in candidates:
+            try:
+                start = yield self.fork_point(address)
+                if start is None:
+                    continue  # Different genesis block
+                blocks = yield self.fetch_blocks(address, start, status["height"])
+            except (PeerError, defer.TimeoutError, defer.FirstError, error.ConnectError):
+                continue
+
+            if len(blocks) == status["height"] - start and self.blockchain.replace_chain(blocks):
+                return True
+
+        return False
+
+
+if __name__ == "__main__":
+    from twisted.internet import task
+
+    from modbus_blockchain import Blockchain
+
+    @defer.inlineCallbacks
+    def start(port, peers):
+        """Start a node that joins its first peer's chain, or a new chain without peers, and mines a block every 10 s"""
+        node = Node(None, port)
+        genesis = None
+        if peers:
+            reply = yield node.request(peers[0], {"type": "blocks", "start": 0, "stop": 1})
+            genesis = reply["blocks"][0]
+        node.blockchain = Blockchain(genesis=genesis)
+        for peer in peers:
+            node.register_node(peer)
+        node.listen()
+
+        def consensus():
+            replaced = yield node.resolve_conflicts()
+            if replaced:
+                print(f"Our chain was replaced; it is {len(node.blockchain.chain)} blocks long")
+
+        task.LoopingCall(defer.inlineCallbacks(consensus)).start(5.0)
+        task.LoopingCall(node.blockchain.mine_batch).start(10.0, now=False)
+
+    # p2p_node.py PORT [PEER_HOST:PEER_PORT ...]
+    start(int(sys.argv[1]) if len(sys.argv) > 1 else 8000, sys.argv[2:])
+    reactor.run()
@@ -0,0 +1,43 @@
+"""Compares proof of work hash rates.
+
+The baseline is the original Blockchain.proof_of_work loop, which rebuilds and hashes the whole guess and compares
+hex digits for every nonce. The midstate search hashes the last proof once and compares raw digest bytes.
+"""
+import hashlib
+import time
+
+import mining
+
+LAST_PROOFS = [100, 35293, 35089, 54822, 18061]
+
+
+def baseline_proof_of_work(last_proof):
+    proof = 0
+    while True:
+        guess = f'{last_proof}{proof}'.encode()
+        guess_hash = hashlib.sha256(guess).hexdigest()
+        if guess_hash[:4] == "0000":
+            return proof
+        proof += 1
+
+
+def hash_rate(proof_of_work):
+    """Hashes per second over all LAST_PROOFS; also returns the proofs found."""
+    proofs = []
+    started = time.perf_counter()
+    for last_proof in LAST_PROOFS:
+        proofs.append(proof_of_work(last_proof))
+    elapsed = time.perf_counter() - started
+
+    hashes = sum(proofs) + len(proofs)  # Every nonce up to and including the proof is hashed once
+    return hashes / elapsed, proofs
+
+
+if __name__ == "__main__":
+    baseline_rate, baseline_proofs = hash_rate(baseline_proof_of_work)
+    midstate_rate, midstate_proofs = hash_rate(mining.serial_proof_of_work)
+    assert baseline_proofs == midstate_proofs, "Midstate search disagrees with valid_proof"
+
+    print(f"Baseline loop:   {baseline_rate:12,.0f} hashes/sec")
+    print(f"Midstate search: {midstate_rate:12,.0f} hashes/sec")
+    print(f"Speedup:         {midstate_rate / baseline_rate:12.2f}x")
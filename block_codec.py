@@ -0,0 +1,162 @@
+"""Canonical binary encoding of blocks.
+
+Every value is written as a one byte type tag followed by its contents, so equal blocks always produce identical bytes
+and the encoding can be hashed directly in memory. Dict keys are written in sorted order, ints are written in full
+(targets are 256-bit), and floats are written as IEEE 754 doubles so timestamps survive exactly.
+
+Modbus PDUs (pymodbus requests and responses) are written as their function code, the MBAP fields cmd_hash covers
+(transaction id, protocol id and unit id) and their own encoded frame, and are decoded back into pymodbus responses
+with those fields restored, so a stored command still hashes to its recorded digest. Tuples come back as lists; both
+encode the same, so digests are unaffected.
+"""
+import hashlib
+import struct
+
+_LENGTH = struct.Struct(">I")
+_DOUBLE = struct.Struct(">d")
+_MBAP_FIELDS = struct.Struct(">BHHB")  # Function code, transaction id, protocol id, unit id
+
+
+def encode(value):
+    """Canonical bytes of a value."""
+    out = bytearray()
+    _encode(value, out)
+
+    return bytes(out)
+
+
+def _encode(value, out):
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        raw = value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+        out += b"i" + _LENGTH.pack(len(raw)) + raw
+    elif isinstance(value, float):
+        out += b"f" + _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode("utf-8")
+        out += b"s" + _LENGTH.pack(len(raw)) + raw
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        raw = memoryview(value)  # Sized in bytes, whatever the item size of a view
+        out += b"b" + _LENGTH.pack(raw.nbytes)
+        out += raw
+    elif isinstance(value, (list, tuple)):
+        out += b"l" + _LENGTH.pack(len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b"d" + _LENGTH.pack(len(value))
+        for key in sorted(value):
+            _encode(key, out)
+            _encode(value[key], out)
+    elif hasattr(value, "function_code") and hasattr(value, "encode"):
+        pdu = value.encode()
+        out += b"M" + _MBAP_FIELDS.pack(value.function_code, value.transaction_id, value.protocol_id, value.unit_id)
+        out += _LENGTH.pack(len(pdu)) + pdu
+    else:
+        raise TypeError(f"Cannot canonically encode {type(value).__name__}")
+
+
+def decode(data):
+    """Value from its canonical bytes."""
+    view = memoryview(data)
+    value, end = _decode(view, 0)
+    if end != len(view):
+        raise ValueError("Trailing bytes after encoded value")
+
+    return value
+
+
+def _decode(view, pos):
+    tag = view[pos:pos + 1].tobytes()
+    pos += 1
+
+    if tag == b"N":
+        return None, pos
+    elif tag == b"T":
+        return True, pos
+    elif tag == b"F":
+        return False, pos
+    elif tag == b"f":
+        return _DOUBLE.unpack_from(view, pos)[0], pos + _DOUBLE.size
+    elif tag == b"l":
+        count, = _LENGTH.unpack_from(view, pos)
+        pos += _LENGTH.size
+        items = []
+        for _ in range(count):
+            item, pos = _decode(view, pos)
+            items.append(item)
+        return items, pos
+    elif tag == b"d":
+        count, = _LENGTH.unpack_from(view, pos)
+        pos += _LENGTH.size
+        items = {}
+        for _ in range(count):
+            key, pos = _decode(view, pos)
+            items[key], pos = _decode(view, pos)
+        return items, pos
+    elif tag == b"M":
+        function_code, transaction_id, protocol_id, unit_id = _MBAP_FIELDS.unpack_from(view, pos)
+        pos += _MBAP_FIELDS.size
+    elif tag not in (b"i", b"s", b"b"):
+        raise ValueError(f"Unknown type tag {tag!r}")
+
+    size, = _LENGTH.unpack_from(view, pos)
+    start = pos + _LENGTH.size
+    raw = view[start:start + size].tobytes()
+    if len(raw) != size:
+        raise ValueError("Truncated encoded value")
+
+    if tag == b"i":
+        return int.from_bytes(raw, "big", signed=True), start + size
+    elif tag == b"s":
+        return raw.decode("utf-8"), start + size
+    elif tag == b"b":
+        return raw, start + size
+
+    return decode_pdu(function_code, raw, transaction_id, protocol_id, unit_id), start + size
+
+
+def decode_pdu(function_code, pdu, transaction_id=0, protocol_id=0, unit_id=0):
+    """pymodbus response for a function code and its encoded frame, with its MBAP fields."""
+    from pymodbus.factory import ClientDecoder  # Only needed when reading blocks back
+
+    response = ClientDecoder().decode(bytes([function_code]) + pdu)
+    if response is None:
+        raise ValueError(f"Cannot decode Modbus function code {function_code}")
+    response.transaction_id = transaction_id
+    response.protocol_id = protocol_id
+    response.unit_id = unit_id
+
+    return response
+
+
+HEADER_FIELDS = ("index", "timestamp", "proof", "target", "previous_hash", "merkle_root")
+
+
+def block_header(block):
+    """A block without its body: the header fields and the stored digest, which covers exactly those fields.
+
+    The transactions are left out; the Merkle root commits to them.
+    """
+    header = {field: block[field] for field in HEADER_FIELDS}
+    header["block_hash"] = block["block_hash"]
+
+    return header
+
+
+def encode_block(block):
+    """Canonical bytes of a block's header: everything but its transactions and its own stored digest.
+
+    The transactions are covered by the header's Merkle root instead.
+    """
+    return encode({key: value for key, value in block.items() if key not in ("block_hash", "transactions")})
+
+
+def block_hash(block):
+    """Hex SHA-256 digest of a block header's canonical encoding."""
+    return hashlib.sha256(encode_block(block)).hexdigest()
@@ -0,0 +1,128 @@
+"""Tree of recent blocks on competing branches, for fork choice by cumulative work.
+
+Every block added is checked against its own parent and branch (linkage, proof of work, digest, Merkle root and the
+target the retargeter sets on that branch) and scored with the total work of the branch ending at it. The best tip is
+the block with the most cumulative work; a branch that overtakes the active chain is switched to by a reorg that
+touches only the blocks after the fork point (see Blockchain.add_block).
+
+Only blocks within `max_depth` of the best tip are kept, so the tree stays small however long the chain grows; a fork
+deeper than that is refused. A branch reaching the active chain reads the heights below that point from the chain,
+so the retarget window of a block may reach below the blocks kept.
+"""
+from collections import defaultdict
+
+import validation
+from difficulty import expected_work
+
+
+class Branch:
+    """Read-only sequence view of the chain ending at a block of a BlockTree, as Retargeter.next_target needs it.
+
+    Heights are found by walking parent links back from the tip, so reading near the tip is cheap. Once the walk reaches
+    a block of the tree's active chain, the rest of the branch is that chain's and is read from it.
+    """
+    def __init__(self, tree, tip):
+        self.tree = tree
+        self.tip = tip
+
+    def __len__(self):
+        return self.tree.heights[self.tip] + 1
+
+    def __bool__(self):
+        return True
+
+    def __getitem__(self, height):
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError("Branch height out of range")
+
+        block_hash = self.tip
+        for _ in range(len(self) - 1 - height):
+            if block_hash in self.tree.chain_heights:
+                break  # The rest of the branch is the active chain's
+            block_hash = self.tree.blocks[block_hash]["previous_hash"]
+            if block_hash not in self.tree.blocks and block_hash not in self.tree.chain_heights:
+                raise IndexError(f"Height {height} is below the blocks kept in the tree")
+
+        if block_hash in self.tree.chain_heights:
+            return self.tree.chain[height]
+        return self.tree.blocks[block_hash]
+
+
+class BlockTree:
+    """Recent blocks of every known branch, by hash.
+
+    :param max_depth: Number of blocks below the best tip that are kept
+    :param chain: The active chain, read for the heights of a branch below where it meets the chain
+    :param chain_heights: Block hash to height of the active chain
+    """
+    def __init__(self, max_depth=1000, chain=(), chain_heights=None):
+        self.max_depth = max_depth
+        self.chain = chain
+        self.chain_heights = chain_heights if chain_heights is not None else {}
+        self.blocks = {}  # Block hash to block
+        self.heights = {}  # Block hash to height
+        self.work = {}  # Block hash to the cumulative work of the branch ending at it
+        self.by_height = defaultdict(set)  # Height to the hashes of the blocks at it
+        self.best = None  # Hash of the block with the most cumulative work
+        self._floor = None  # Lowest height kept
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def add_trusted(self, block, height, work):
+        """Add a block without checking it, e.g. from our own validated chain, with its height and cumulative work"""
+        block_hash = block["block_hash"]
+        self.blocks[block_hash] = block
+        self.heights[block_hash] = height
+        self.work[block_hash] = work
+        self.by_height[height].add(block_hash)
+        if self._floor is None or height < self._floor:
+            self._floor = height
+        if self.best is None or work > self.work[self.best]:
+            self.best = block_hash
+        self._prune()
+
+    def add(self, block, retargeter):
+        """Check a block against its parent in the tree and add it; returns False if it is unknown or invalid"""
+        parent_hash = block["previous_hash"]
+        if block["block_hash"] in self.blocks or parent_hash not in self.blocks:
+            return False
+
+        try:
+            target = retargeter.next_target(Branch(self, parent_hash))
+        except IndexError:  # The retarget window reaches below the tree on a branch off the active chain
+            return False
+        if block["target"] != target:
+            return False
+        if not validation.valid_block(block, self.blocks[parent_hash]):
+            return False
+
+        self.add_trusted(block, self.heights[parent_hash] + 1, self.work[parent_hash] + expected_work(block["target"]))
+        return True
+
+    def branch(self, tip, stop):
+        """Blocks on the branch ending at `tip`, walking back until a block for which stop(hash) is true
+
+        Returns that block's hash and the blocks after it, oldest first; the hash is None if the walk left the tree.
+        """
+        blocks = []
+        block_hash = tip
+        while block_hash in self.blocks and not stop(block_hash):
+            blocks.append(self.blocks[block_hash])
+            block_hash = self.blocks[block_hash]["previous_hash"]
+
+        blocks.reverse()
+        return (block_hash if block_hash in self.blocks else None), blocks
+
+    def _prune(self):
+        while self._floor < self.heights[self.best] - self.max_depth:
+            for block_hash in self.by_height.pop(self._floor, ()):
+                del self.blocks[block_hash]
+                del self.heights[block_hash]
+                del self.work[block_hash]
+            self._floor += 1
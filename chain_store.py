@@ -0,0 +1,339 @@
+"""Append-only on-disk chain storage.
+
+Blocks are appended to numbered segment files as length-prefixed records (see records.py):
+
+    [payload length: 4 bytes][CRC-32 of payload: 4 bytes][canonically encoded block]
+
+A segment is only ever appended to, or cut back from its end by truncate() when a reorg drops the last blocks; once it
+reaches `segment_size` a new one is started. Writes are group committed: the segment is fsync'ed after `sync_every`
+blocks or `sync_interval` seconds, whichever comes first, instead of after every block. A crash can therefore lose the
+last few unsynced blocks, and a record torn by the crash fails its CRC and is cut off when the store is reopened.
+
+Reads go through read-only memory maps of the segments, so historical blocks are decoded on demand instead of keeping
+the whole chain in memory. ChainStore behaves like the list Blockchain.chain used to be, so it can be used in its place.
+
+Next to the segments, index.dat holds one fixed-size record per block, in height order:
+
+    [block digest: 32 bytes][segment: 4 bytes][offset: 8 bytes][cumulative work of the chain up to the block: 40 bytes]
+
+It is appended to along with the segments and loaded on open, so blocks can be found by hash or height without scanning
+the segments, and the chain's total proof of work is known without decoding a single block. Only blocks appended after
+the last index record (a crash between the two writes) are rescanned.
+"""
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import block_codec
+import records
+from difficulty import expected_work
+
+_INDEX_RECORD = struct.Struct(">32sIQ40s")  # Block digest, segment, offset, cumulative work
+_WORK_SIZE = 40
+
+
+class ChainStore:
+    """Append-only segmented block store.
+
+    :param directory: Directory holding the segment files; created if missing
+    :param segment_size: Size in bytes after which a new segment is started
+    :param sync_every: Number of appended blocks after which the active segment is fsync'ed
+    :param sync_interval: Seconds after which the active segment is fsync'ed on the next append
+    :param read_only: Open without writing anything, e.g. from another process while a node owns the store; only
+        blocks already recorded in the index are visible, until refresh() picks up the ones appended since
+    """
+    segment_name = "segment-{:06d}.dat"
+    index_name = "index.dat"
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, sync_every=32, sync_interval=1.0, read_only=False):
+        self.directory = directory
+        self.read_only = read_only
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.locations = []  # (segment, offset) of each block, by height
+        self.heights = {}  # Block digest (hex) to height
+        self.work = 0  # Cumulative proof of work of the stored chain (difficulty.expected_work)
+        self._maps = {}
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        segments = sorted(int(name[8:14]) for name in os.listdir(directory)
+                          if name.startswith("segment-") and name.endswith(".dat"))
+        self.active_segment = segments[-1] if segments else 0
+        self._load_index()
+        if read_only:
+            self._file = self._index_file = None
+            return
+        self._index_file = open(os.path.join(directory, self.index_name), "ab")
+
+        # Pick up blocks the index doesn't cover yet
+        if self.locations:
+            segment, offset = self.locations[-1]
+            self.recover_segment(segment, self._record_end(segment, offset))
+            segments = [number for number in segments if number > segment]
+        for segment in segments:
+            self.recover_segment(segment)
+
+        self._file = open(self.segment_path(self.active_segment), "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self.read(*location) for location in self.locations[height]]
+
+        return self.read(*self.locations[height])
+
+    def __iter__(self):
+        for location in self.locations:
+            yield self.read(*location)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, self.segment_name.format(segment))
+
+    def _load_index(self):
+        """Load index.dat, dropping trailing records that point past the data actually on disk."""
+        path = os.path.join(self.directory, self.index_name)
+        if not os.path.exists(path):
+            return
+
+        with open(path, "rb") as index_file:
+            data = index_file.read()
+
+        self._add_index_records(data)
+        if len(self.locations) * _INDEX_RECORD.size != len(data) and not self.read_only:
+            os.truncate(path, len(self.locations) * _INDEX_RECORD.size)
+
+    def _add_index_records(self, data):
+        """Add the complete index records in `data` after the blocks already indexed, leaving out trailing ones that
+        point past the data actually on disk."""
+        start = len(self.locations)
+        digests = []
+        works = []
+        records = data[:len(data) - len(data) % _INDEX_RECORD.size]
+        for digest, segment, offset, work in _INDEX_RECORD.iter_unpack(records):
+            digests.append(digest.hex())
+            works.append(work)
+            self.locations.append((segment, offset))
+
+        while len(self.locations) > start and self._record_end(*self.locations[-1]) is None:
+            self.locations.pop()
+            digests.pop()
+            works.pop()
+        self.heights.update(zip(digests, range(start, len(self.locations))))
+        if works:
+            self.work = int.from_bytes(works[-1], "big")
+
+    def refresh(self):
+        """Pick up the blocks the owning node appended since this read-only store was opened or last refreshed.
+
+        Returns the height from which blocks may differ from what the store held before: the old length if blocks
+        were only appended, or 0 if the node cut the chain back, e.g. in a reorg, and the index is reloaded.
+        """
+        if not self.read_only:
+            raise ValueError("Only a store opened read only needs refreshing")
+
+        path = os.path.join(self.directory, self.index_name)
+        known = len(self.locations)
+        if not os.path.exists(path):
+            return known
+        with open(path, "rb") as index_file:
+            index_file.seek(max(known - 1, 0) * _INDEX_RECORD.size)
+            last = index_file.read(_INDEX_RECORD.size) if known else None
+            data = index_file.read()
+
+        if known and (len(last) < _INDEX_RECORD.size or
+                      self.heights.get(_INDEX_RECORD.unpack(last)[0].hex()) != known - 1):
+            for mapped in self._maps.values():
+                mapped.close()  # The node may have cut the segments they map
+            self._maps.clear()
+            del self.locations[:]
+            self.heights.clear()  # In place, as a Blockchain shares it as its block_heights
+            self.work = 0
+            self._load_index()
+            return 0
+
+        self._add_index_records(data)
+        return known
+
+    def _record_end(self, segment, offset):
+        """Offset just past the record at (segment, offset), or None if the record isn't complete on disk."""
+        path = self.segment_path(segment)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as segment_file:
+            size = segment_file.seek(0, os.SEEK_END)
+            segment_file.seek(offset)
+            header = segment_file.read(records.HEADER.size)
+        if len(header) < records.HEADER.size:
+            return None
+
+        length, _ = records.HEADER.unpack(header)
+        end = offset + records.HEADER.size + length
+
+        return end if end <= size else None
+
+    def _index(self, block, segment, offset):
+        self.heights[block["block_hash"]] = len(self.locations)
+        self.locations.append((segment, offset))
+        self.work += expected_work(block["target"])
+        self._index_file.write(_INDEX_RECORD.pack(bytes.fromhex(block["block_hash"]), segment, offset,
+                                                  self.work.to_bytes(_WORK_SIZE, "big")))
+
+    def height_of(self, block_hash):
+        """Height of the block with this digest, or None if it isn't stored."""
+        return self.heights.get(block_hash)
+
+    def get_block_by_hash(self, block_hash):
+        """Block with this digest, or None if it isn't stored."""
+        height = self.heights.get(block_hash)
+
+        return None if height is None else self.read(*self.locations[height])
+
+    def get_block_by_height(self, height):
+        """Block at this height; the genesis block is height 0."""
+        return self.read(*self.locations[height])
+
+    def recover_segment(self, segment, offset=0):
+        """Index every intact block in a segment from `offset` on and cut off a torn tail."""
+        path = self.segment_path(segment)
+        size = os.path.getsize(path)
+
+        if size:
+            with open(path, "rb") as segment_file, \
+                    mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start, end, payload in records.scan(data, offset):
+                    self._index(block_codec.decode(payload), segment, start)
+                    offset = end
+
+        if offset != size:
+            os.truncate(path, offset)
+
+    def append(self, block):
+        """Append a block; returns its (segment, offset)."""
+        if self.read_only:
+            raise ValueError("Cannot append to a store opened read only")
+
+        record = records.pack(block_codec.encode(block))
+
+        offset = self._file.tell()
+        if offset and offset + len(record) > self.segment_size:
+            self.sync()
+            self._file.close()
+            self.active_segment += 1
+            self._file = open(self.segment_path(self.active_segment), "ab")
+            offset = 0
+
+        self._file.write(record)
+        self._index(block, self.active_segment, offset)
+
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+        return self.active_segment, offset
+
+    def truncate(self, length):
+        """Drop the blocks from height `length` on, e.g. when a reorg replaces them.
+
+        The segment holding the first dropped block is cut back to it and later segments are deleted. The segments are
+        cut before the index, so a crash in between leaves index records past the data, which are dropped on open.
+        """
+        if self.read_only:
+            raise ValueError("Cannot truncate a store opened read only")
+        if length >= len(self.locations):
+            return
+
+        self.sync()
+        segment, offset = self.locations[length]
+        with open(os.path.join(self.directory, self.index_name), "rb") as index_file:
+            index_file.seek(max(length - 1, 0) * _INDEX_RECORD.size)
+            kept = index_file.read(_INDEX_RECORD.size) if length else None
+            dropped = index_file.read()
+        for digest, _, _, _ in _INDEX_RECORD.iter_unpack(dropped):
+            del self.heights[digest.hex()]
+        del self.locations[length:]
+        self.work = int.from_bytes(_INDEX_RECORD.unpack(kept)[3], "big") if kept else 0
+
+        # Maps of the cut segments would fault on the missing pages
+        for number in [number for number in self._maps if number >= segment]:
+            self._maps.pop(number).close()
+        self._file.close()
+        for number in range(segment + 1, self.active_segment + 1):
+            os.remove(self.segment_path(number))
+        os.truncate(self.segment_path(segment), offset)
+        self.active_segment = segment
+        self._file = open(self.segment_path(segment), "ab")
+
+        self._index_file.flush()
+        os.truncate(os.path.join(self.directory, self.index_name), length * _INDEX_RECORD.size)
+        self.sync()
+
+    def sync(self):
+        """Flush and fsync everything appended so far.
+
+        Blocks are synced before their index records, so a synced index never points at missing blocks.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def read(self, segment, offset):
+        """Decode the block stored at (segment, offset)."""
+        data = self._map(segment, offset + records.HEADER.size)
+        length, crc = records.HEADER.unpack_from(data, offset)
+        start = offset + records.HEADER.size
+        data = self._map(segment, start + length)
+
+        payload = memoryview(data)[start:start + length]
+        try:
+            if zlib.crc32(payload) != crc:
+                raise ValueError(f"Corrupt block record at segment {segment}, offset {offset}")
+            return block_codec.decode(payload)
+        finally:
+            payload.release()
+
+    def _map(self, segment, needed):
+        """Memory map of a segment that covers at least `needed` bytes.
+
+        The active segment grows, so its map is replaced whenever a read reaches past the end of the current one.
+        """
+        data = self._maps.get(segment)
+        if data is None or len(data) < needed:
+            if segment == self.active_segment and self._file is not None:
+                self._file.flush()
+            if data is not None:
+                data.close()
+            with open(self.segment_path(segment), "rb") as segment_file:
+                data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = data
+
+        return data
+
+    def close(self):
+        """Sync and close all files."""
+        if self._file is not None:
+            if self._file.closed:
+                return
+            self.sync()
+            self._file.close()
+            self._index_file.close()
+
+        for data in self._maps.values():
+            data.close()
+        self._maps.clear()
@@ -0,0 +1,83 @@
+"""Proof of work difficulty.
+
+Difficulty is a numeric target: a proof is valid when the SHA-256 digest of the guess, read as a 256-bit big-endian
+integer, is below the block's target. A target of 2 ** (256 - n) is the same as requiring n leading zero bits, so the
+original four hex zeros are DEFAULT_BITS = 16. Unlike a hex prefix, the target can be moved in arbitrarily small steps.
+"""
+import math
+
+MAX_TARGET = 2 ** 256 - 1  # Every digest but one is below this; zero difficulty
+DEFAULT_BITS = 16  # Four leading hex zeros
+
+
+def target_from_bits(bits):
+    """Target that requires `bits` leading zero bits."""
+    if not 0 <= bits <= 256:
+        raise ValueError("Difficulty bits must be between 0 and 256")
+
+    return min(2 ** (256 - bits), MAX_TARGET)
+
+
+def bits_from_target(target):
+    """Difficulty of a target in (possibly fractional) leading zero bits."""
+    return 256 - math.log2(target)
+
+
+def target_bytes(target):
+    """Target as 32 big-endian bytes.
+
+    Digests are compared against this directly: for equal-length byte strings, lexicographic order is numeric order.
+    """
+    return target.to_bytes(32, "big")
+
+
+def expected_work(target):
+    """Average number of hashes needed to find a digest below target.
+
+    An integer, so the cumulative work of a chain stays exact however it is added up and compared.
+    """
+    return 2 ** 256 // (target + 1)
+
+
+DEFAULT_TARGET = target_from_bits(DEFAULT_BITS)
+
+
+class Retargeter:
+    """Adjusts the target every `interval` blocks to hold a block interval of `block_time` seconds.
+
+    The adjustment uses the timestamps of the last `interval` blocks: if they were mined twice as fast as intended, the
+    target is halved, and so on. A single adjustment is limited to a factor of `max_adjust` either way so one odd
+    measurement cannot swing the difficulty wildly.
+
+    :param block_time: Desired seconds between blocks
+    :param interval: Number of blocks between adjustments
+    :param max_adjust: Largest factor the target may change by in one adjustment
+    :param initial_target: Target used until the first adjustment
+    """
+    def __init__(self, block_time=10.0, interval=10, max_adjust=4, initial_target=DEFAULT_TARGET):
+        if interval < 1:
+            raise ValueError("Retarget interval must be at least one block")
+
+        self.block_time = block_time
+        self.interval = interval
+        self.max_adjust = max_adjust
+        self.initial_target = initial_target
+
+    def next_target(self, chain):
+        """Target for the block that will be appended to `chain`."""
+        if not chain:
+            return self.initial_target
+
+        last_target = chain[-1].get("target", self.initial_target)
+        if len(chain) % self.interval != 0 or len(chain) <= self.interval:
+            return last_target
+
+        first = chain[-self.interval - 1]
+        actual = chain[-1]["timestamp"] - first["timestamp"]
+        intended = self.block_time * self.interval
+
+        # Clamp the measured time rather than the result, so the arithmetic stays in integers
+        actual = min(max(actual, intended / self.max_adjust), intended * self.max_adjust)
+        new_target = last_target * int(actual * 1000) // int(intended * 1000)
+
+        return min(max(new_target, 1), MAX_TARGET)
@@ -0,0 +1,75 @@
+"""Header-only view of a chain for clients that can't hold block bodies.
+
+A LightClient keeps only block headers (block_codec.block_header), a few hundred bytes each. A header is accepted if
+it carries the target the retargeter sets for it, its digest matches its fields and it links to its parent with a
+valid proof of work, so the tip is as authentic as the work behind it without a single transaction being downloaded.
+Block bodies are fetched on demand and checked against the Merkle root in their header; a single transaction can be
+checked with a Merkle inclusion proof instead of the whole body.
+"""
+import block_codec
+import merkle
+import validation
+from difficulty import Retargeter, expected_work
+
+
+def valid_header(header, parent):
+    """Check a header's digest against its fields and its link and proof of work against its parent"""
+    if block_codec.block_hash(header) != header["block_hash"]:
+        return False
+
+    return validation.valid_link(header, parent)
+
+
+class LightClient:
+    """Chain of verified block headers.
+
+    :param genesis: Genesis block or header, trusted as given; pin its hash out of band
+    :param retargeter: Retargeter with the same settings as the full nodes
+    """
+    def __init__(self, genesis, retargeter=None):
+        genesis = block_codec.block_header(genesis)
+        if block_codec.block_hash(genesis) != genesis["block_hash"]:
+            raise ValueError("Invalid genesis header")
+
+        self.retargeter = retargeter or Retargeter()
+        self.headers = [genesis]
+        self.work = expected_work(genesis["target"])  # Cumulative proof of work
+
+    def __len__(self):
+        return len(self.headers)
+
+    @property
+    def tip(self):
+        return self.headers[-1]
+
+    def add_headers(self, start, headers):
+        """Add a peer's headers for heights start on, replacing ours from there if the peer's carry more work
+
+        Every new header is verified; returns True if they were all valid and were added.
+        """
+        if not 1 <= start <= len(self.headers) or not headers:
+            return False
+
+        dropped = self.headers[start:]
+        work = sum(expected_work(header["target"]) for header in headers)
+        if dropped and work <= sum(expected_work(header["target"]) for header in dropped):
+            return False
+
+        candidate = self.headers[:start]
+        for header in headers:
+            header = block_codec.block_header(header)
+            if header["target"] != self.retargeter.next_target(candidate) or not valid_header(header, candidate[-1]):
+                return False
+            candidate.append(header)
+
+        self.headers = candidate
+        self.work += work - sum(expected_work(header["target"]) for header in dropped)
+        return True
+
+    def valid_body(self, height, transactions):
+        """Check a block body fetched on demand against the Merkle root of its header"""
+        return merkle.merkle_root(transactions) == self.headers[height]["merkle_root"]
+
+    def valid_transaction(self, height, transaction, proof):
+        """Check one transaction of a block with a Merkle inclusion proof (Blockchain.transaction_proof)"""
+        return merkle.verify_inclusion(transaction, proof, self.headers[height]["merkle_root"])
@@ -0,0 +1,144 @@
+"""Pending transactions waiting to be mined.
+
+The pool holds at most `capacity` transactions and ignores a command it already holds between the same sender and
+recipient, keyed on both and the command hash from ModbusTransaction.cmd_and_hash (the second item of "cmd_tuple").
+The sender is the node that issued the command and the recipient the device it was issued to. The hash covers the
+Modbus frame but not the device, and every device numbers its own transaction ids, so the same command to two devices
+is two transactions. When it is full, adding a transaction evicts another:
+
+- "oldest": the transaction that has waited longest is evicted, and transactions are handed out first in, first out.
+- "priority": the lowest priority transaction is evicted (the oldest of equals), and the highest priority transactions
+  are handed out first. A new transaction that ranks below everything in a full pool is rejected instead.
+
+Both orders are kept in heaps, so adding, evicting and taking a transaction cost O(log n). Entries removed from the
+pool are left in the heaps and skipped when they come up.
+"""
+import heapq
+import itertools
+
+import block_codec
+
+OLDEST = "oldest"
+PRIORITY = "priority"
+
+
+class Mempool:
+    """Bounded, deduplicating pool of pending transactions.
+
+    :param capacity: Largest number of transactions held at once
+    :param policy: OLDEST or PRIORITY; see the module docstring
+    """
+    def __init__(self, capacity=10000, policy=OLDEST):
+        if policy not in (OLDEST, PRIORITY):
+            raise ValueError(f"Unknown mempool policy {policy!r}")
+
+        self.capacity = capacity
+        self.policy = policy
+        self.evicted = 0
+        self.size_bytes = 0  # Total canonical encoding size of the pending transactions
+        self._entries = {}  # Key (see key()) to (priority, sequence, transaction, size)
+        self._evict_order = []  # Heap of (priority, sequence, key)
+        self._take_order = []  # Heap of (-priority, sequence, key)
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        """Pending transactions in the order they would be taken."""
+        for _, _, key in sorted(self._live(self._take_order)):
+            yield self._entries[key][2]
+
+    @staticmethod
+    def key(transaction):
+        """What duplicates are detected by: the sender, the recipient and the command hash"""
+        return transaction["sender"], transaction["recipient"], transaction["cmd_tuple"][1]
+
+    def _live(self, heap):
+        return [item for item in heap if item[2] in self._entries and self._entries[item[2]][1] == item[1]]
+
+    def _pop(self, heap):
+        """Pop the first entry of a heap that is still in the pool, or None."""
+        while heap:
+            item = heapq.heappop(heap)
+            entry = self._entries.get(item[2])
+            if entry is not None and entry[1] == item[1]:
+                return item
+        return None
+
+    def add(self, transaction, priority=0):
+        """Add a transaction; returns False if it is a duplicate or was rejected by a full pool."""
+        key = self.key(transaction)
+        if key in self._entries:
+            return False
+
+        if self.policy == OLDEST:
+            priority = 0
+        if len(self._entries) >= self.capacity:
+            lowest = self._pop(self._evict_order)
+            if self.policy == PRIORITY and lowest[0] >= priority:
+                heapq.heappush(self._evict_order, lowest)
+                return False
+            self.size_bytes -= self._entries.pop(lowest[2])[3]
+            self.evicted += 1
+
+        sequence = next(self._sequence)
+        size = len(block_codec.encode(transaction))
+        self._entries[key] = (priority, sequence, transaction, size)
+        self.size_bytes += size
+        heapq.heappush(self._evict_order, (priority, sequence, key))
+        heapq.heappush(self._take_order, (-priority, sequence, key))
+
+        # Keep removed entries from piling up in the heaps
+        if len(self._take_order) > 2 * len(self._entries) + 64:
+            self._take_order = self._live(self._take_order)
+            heapq.heapify(self._take_order)
+        if len(self._evict_order) > 2 * len(self._entries) + 64:
+            self._evict_order = self._live(self._evict_order)
+            heapq.heapify(self._evict_order)
+
+        return True
+
+    def discard(self, key):
+        """Remove a pending transaction by key(), e.g. one a block from a peer holds; returns False if it isn't here."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+
+        self.size_bytes -= entry[3]
+        return True
+
+    def take(self, max_count=None, max_bytes=None):
+        """Remove and return the next batch of transactions for a block
+
+        The batch holds at most `max_count` transactions whose canonical encodings add up to at most `max_bytes`.
+        Transactions that don't fit in the remaining space are left in the pool for a later block; one that is larger
+        than `max_bytes` on its own is handed out alone, so it can't hold up the pool forever.
+        """
+        batch = []
+        skipped = []
+        used = 0
+
+        while max_count is None or len(batch) < max_count:
+            item = self._pop(self._take_order)
+            if item is None:
+                break
+
+            size = self._entries[item[2]][3]
+            if max_bytes is not None and batch and used + size > max_bytes:
+                skipped.append(item)
+                if used == max_bytes:
+                    break
+                continue
+
+            batch.append(self._entries.pop(item[2])[2])
+            used += size
+            self.size_bytes -= size
+
+        for item in skipped:
+            heapq.heappush(self._take_order, item)
+
+        return batch
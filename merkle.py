@@ -0,0 +1,72 @@
+"""Merkle trees over block transactions.
+
+Leaves are the SHA-256 digests of the transactions' canonical encodings. Leaf and inner node hashes are prefixed with
+different bytes (as in RFC 6962), so an inner node can never be passed off as a transaction. A node without a sibling
+on its level is carried up unchanged rather than paired with itself, which would let two different transaction lists
+share a root.
+
+An inclusion proof is the list of sibling hashes on the path from a leaf to the root, each marked with the side it
+sits on, so proving one transaction takes O(log n) hashes instead of the whole block.
+"""
+import hashlib
+
+import block_codec
+
+_LEAF = b"\x00"
+_NODE = b"\x01"
+EMPTY_ROOT = hashlib.sha256(b"").hexdigest()
+
+
+def leaf_hash(transaction):
+    return hashlib.sha256(_LEAF + block_codec.encode(transaction)).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(_NODE + left + right).digest()
+
+
+def _next_level(level):
+    paired = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        paired.append(level[-1])
+
+    return paired
+
+
+def merkle_root(transactions):
+    """Hex Merkle root of a list of transactions"""
+    if not transactions:
+        return EMPTY_ROOT
+
+    level = [leaf_hash(transaction) for transaction in transactions]
+    while len(level) > 1:
+        level = _next_level(level)
+
+    return level[0].hex()
+
+
+def inclusion_proof(transactions, position):
+    """Proof that transactions[position] is in the tree: a list of ("left" | "right", sibling hex digest)"""
+    if not 0 <= position < len(transactions):
+        raise IndexError("Transaction position out of range")
+
+    proof = []
+    level = [leaf_hash(transaction) for transaction in transactions]
+    while len(level) > 1:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append(("left" if sibling < position else "right", level[sibling].hex()))
+        level = _next_level(level)
+        position //= 2
+
+    return proof
+
+
+def verify_inclusion(transaction, proof, root):
+    """Check an inclusion proof of a transaction against a hex Merkle root"""
+    digest = leaf_hash(transaction)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        digest = node_hash(sibling, digest) if side == "left" else node_hash(digest, sibling)
+
+    return digest.hex() == root
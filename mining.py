@@ -0,0 +1,165 @@
+"""Proof of work search.
+
+The nonce space is split into contiguous chunks that are handed to a pool of worker processes. Workers share the
+lowest proof found so far and abandon any chunk that starts above it, so the search stops as soon as a proof is found
+and the returned proof is always the lowest valid one, i.e. the same proof the serial search would return.
+"""
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import Value
+
+from difficulty import DEFAULT_TARGET, expected_work, target_bytes
+
+_NOT_FOUND = 2 ** 63 - 1  # Shared sentinel; larger than any proof we will ever search
+_found = None  # Lowest proof found so far, shared by all workers of a pool
+
+
+def valid_proof(last_proof, proof, target=DEFAULT_TARGET):
+    """Validates proof of work"""
+    guess = f'{last_proof}{proof}'.encode()
+    guess_hash = hashlib.sha256(guess).digest()
+
+    return guess_hash < target_bytes(target)
+
+
+def search_range(last_proof, start, stop, target=DEFAULT_TARGET):
+    """Return the lowest valid proof in [start, stop), or None if there isn't one.
+
+    The guess is always `last_proof` followed by the candidate, so the prefix is hashed once and each candidate only
+    continues from a copy of that midstate. The result is exactly what valid_proof would accept.
+    """
+    midstate = hashlib.sha256(f'{last_proof}'.encode())
+    clone = midstate.copy
+    below = target_bytes(target)
+
+    for proof in range(start, stop):
+        guess_hash = clone()
+        guess_hash.update(b'%d' % proof)
+        if guess_hash.digest() < below:
+            return proof
+
+    return None
+
+
+def serial_proof_of_work(last_proof, target=DEFAULT_TARGET, chunk_size=1 << 16):
+    """Find the lowest valid proof on the current core."""
+    start = 0
+    while True:
+        proof = search_range(last_proof, start, start + chunk_size, target)
+        if proof is not None:
+            return proof
+        start += chunk_size
+
+
+def _init_worker(found):
+    global _found
+    _found = found
+
+
+def _search_chunk(last_proof, start, stop, target, check_every):
+    """Search one chunk in a worker process.
+
+    The shared result is polled every `check_every` nonces; once another worker has found a proof below the part of
+    the chunk that is still unsearched, there is nothing left to find here.
+    """
+    for low in range(start, stop, check_every):
+        if _found.value < low:
+            return None
+
+        proof = search_range(last_proof, low, min(low + check_every, stop), target)
+        if proof is not None:
+            with _found.get_lock():
+                if proof < _found.value:
+                    _found.value = proof
+            return proof
+
+    return None
+
+
+def available_cpus():
+    """Number of CPUs this process is allowed to run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on every platform
+        return os.cpu_count() or 1
+
+
+class ParallelMiner:
+    """Searches for proofs of work across a process pool.
+
+    :param workers: Number of worker processes; defaults to the number of usable CPUs
+    :param chunk_size: Nonces per task; measured from the local hash rate when not given
+    :param chunk_seconds: Target run time of one chunk when the chunk size is tuned automatically
+    :param check_every: How many nonces a worker searches between checks for a result from another worker
+    """
+    calibration_nonces = 20000
+
+    def __init__(self, workers=None, chunk_size=None, chunk_seconds=0.05, check_every=2048):
+        self.workers = workers or available_cpus()
+        self.chunk_size = chunk_size
+        self.chunk_seconds = chunk_seconds
+        self.check_every = check_every
+        self.hash_rate = None
+        self._found = None
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down the worker processes."""
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def calibrate(self):
+        """Measure the single-core hash rate and derive the chunk size from it."""
+        started = time.perf_counter()
+        search_range(0, 0, self.calibration_nonces, target=0)  # Nothing is below 0, so every nonce is hashed
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        self.hash_rate = self.calibration_nonces / elapsed
+
+        if self.chunk_size is None:
+            size = int(self.hash_rate * self.chunk_seconds)
+            self.chunk_size = min(max(size, self.check_every), 1 << 24)
+
+        return self.hash_rate
+
+    def proof_of_work(self, last_proof, target=DEFAULT_TARGET):
+        """Find the lowest proof p` such that hash(pp`) is below target."""
+        if self.hash_rate is None:
+            self.calibrate()
+
+        # Starting the pool costs more than a search that finishes in a fraction of a second on one core
+        if self.workers == 1 or expected_work(target) < self.hash_rate * 0.25:
+            return serial_proof_of_work(last_proof, target)
+
+        if self._pool is None:
+            self._found = Value('q', _NOT_FOUND)
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self._found,))
+        self._found.value = _NOT_FOUND
+
+        next_start = 0
+        pending = set()
+        best = None
+
+        while True:
+            # Keep two chunks per worker queued so no worker idles between tasks
+            while best is None and len(pending) < self.workers * 2:
+                pending.add(self._pool.submit(_search_chunk, last_proof, next_start,
+                                              next_start + self.chunk_size, target, self.check_every))
+                next_start += self.chunk_size
+
+            if not pending:
+                return best
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                proof = future.result()
+                if proof is not None and (best is None or proof < best):
+                    best = proof
@@ -1,27 +1,89 @@
-import hashlib
-import pickle
+import os
 import pprint
+import queue
+import threading
 
-from time import time
+from time import perf_counter, time
 from urllib.parse import urlparse
 from Modbus.hashing_server import ModbusTransaction
+from block_tree import BlockTree
+from difficulty import DEFAULT_TARGET, Retargeter, expected_work
+from mempool import Mempool
+from tx_index import COILS, TransactionIndex
+import block_codec
+import merkle
+import mining
+import validation
+
+_DONE = object()  # Passed through the queue of mine_from when the stream of transactions ends
+
+
+def _read_transactions(transactions, arrivals, stopped):
+    """Put every item of a stream on a queue, then _DONE and the exception that ended the stream, if any
+
+    Once `stopped` is set no more items are read, so a stream that issues Modbus commands doesn't keep issuing them for
+    a consumer that has gone.
+    """
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                arrivals.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for item in transactions:
+            if not put((item, None)) or stopped.is_set():
+                return
+    except Exception as error:
+        put((_DONE, error))
+    else:
+        put((_DONE, None))
 
 
 class Blockchain:
-    def __init__(self):
-        self.chain = []
-        self.current_transactions = []
+    def __init__(self, miner=None, retargeter=None, store=None, validator=None, mempool=None,
+                 max_block_transactions=None, max_block_bytes=None, genesis=None, reorg_depth=1000):
+        self.retargeter = retargeter or Retargeter()  # Sets the proof of work target of each new block
+        if reorg_depth <= self.retargeter.interval:
+            raise ValueError("reorg_depth must be larger than the retarget interval")
+
+        self.chain = store if store is not None else []  # A chain_store.ChainStore keeps the chain on disk
+        self.block_heights = store.heights if store is not None else {}  # Block hash to height; genesis is height 0
+        self.tx_index = TransactionIndex()  # Commands by sender, recipient, unit and address
+        if store is not None and not store.read_only:  # Kept next to the store, so it survives restarts
+            self.tx_index = TransactionIndex(os.path.join(store.directory, "tx_index.dat"), store.heights)
+        self.validator = validator or validation.ChainValidator()  # Remembers the last verified tip
+        self.mempool = mempool or Mempool()  # Pending transactions, bounded and deduplicated
+        self.max_block_transactions = max_block_transactions  # Block size limits; no limit if None
+        self.max_block_bytes = max_block_bytes
         self.last_proof = None
         self.proof = None
+        self.target = None
         self.previous_hash = None
         self.block = None
         self.block_hash = None
         self.sender = None
         self.recipient = None
         self.modbus_cmd = None
-
-        self.genesis_block = self.new_block(previous_hash=1, proof=100)  # Create the genesis block
-        # self.nodes = set()  # List of nodes in blockchain n/w; ensures specific node only appears once
+        self.miner = miner  # Optional mining.ParallelMiner; proofs are searched serially without one
+        self.nodes = set()  # Network addresses (host:port) of peer nodes; ensures specific node only appears once
+        self.work = store.work if store is not None else 0  # Cumulative proof of work; a store keeps it in its index
+        # Recent blocks of our chain and of competing branches, for fork choice
+        self.tree = BlockTree(reorg_depth, self.chain, self.block_heights)
+
+        if self.chain:
+            self.genesis_block = self.chain[0]  # Reopened store
+            self._seed_tree()
+        elif genesis is not None:
+            if not validation.valid_contents(genesis):
+                raise ValueError("Invalid genesis block")
+            self._append(genesis)  # A peer's genesis block, to replicate its chain
+            self.genesis_block = genesis
+        else:
+            self.genesis_block = self.new_block(previous_hash=1, proof=100)  # Create the genesis block
 
     @property
     def last_block(self):
@@ -33,121 +95,330 @@ class Blockchain:
         """Add block to end of chain"""
         self.chain.append(block)
 
-    @property
-    def full_chain(self):
-        """Display the entire blockchain."""
-        return {"chain": self.chain, "length": len(self.chain)}
+    def get_block_by_hash(self, block_hash):
+        """Return the block with this hash, or None if it isn't in the chain"""
+        height = self.block_heights.get(block_hash)
 
-    @property
-    def pickle_cmd(self):
-        with open("cmd.pickle", "r") as modbus_cmd:
-            return modbus_cmd
+        return None if height is None else self.chain[height]
 
-    @pickle_cmd.setter
-    def pickle_cmd(self, cmd):
-        """Serialize modbus command."""
-        with open("cmd.pickle", "wb") as modbus_cmd:
-            pickle.dump(cmd, modbus_cmd)
+    def get_block_by_height(self, height):
+        """Return the block at this height; the genesis block is height 0"""
+        return self.chain[height]
 
-    @property
-    def pickle_block(self):
-        with open("block.pickle", "r") as modbus_block:
-            return modbus_block
+    def find_transactions(self, sender=None, recipient=None, unit=None, address=None, table=COILS):
+        """Yield (height, position, transaction) for every transaction matching all of the given criteria
+
+        `address` is a coil or register address in `table`; see tx_index for the table names.
+        """
+        self.tx_index.catch_up(self.chain)
+
+        return self.tx_index.transactions(self.chain, sender=sender, recipient=recipient, unit=unit, address=address,
+                                          table=table)
+
+    def transaction_proof(self, height, position):
+        """Return a transaction with a compact proof that it is in the block at this height
+
+        The proof is checked with merkle.verify_inclusion against the block's "merkle_root", which is part of the
+        header that "block_hash" covers.
+        """
+        block = self.chain[height]
+
+        return {
+            "transaction": block["transactions"][position],
+            "proof": merkle.inclusion_proof(block["transactions"], position),
+            "merkle_root": block["merkle_root"],
+            "block_hash": block["block_hash"],
+        }
+
+    def headers(self, start=0, stop=None):
+        """Block headers (block_codec.block_header) at heights start to stop - 1, without the transactions"""
+        stop = len(self.chain) if stop is None else min(stop, len(self.chain))
 
-    @pickle_block.setter
-    def pickle_block(self, block):
-        """Serialize hashed block"""
-        with open("block.pickle", "wb") as modbus_block:
-            pickle.dump(block, modbus_block)
+        return [block_codec.block_header(self.chain[height]) for height in range(start, stop)]
+
+    def close(self):
+        """Save the transaction index and close the chain store, if the chain is kept on disk"""
+        self.tx_index.close()
+        if not isinstance(self.chain, list):
+            self.chain.close()
+
+    @property
+    def full_chain(self):
+        """Display the entire blockchain."""
+        return {"chain": list(self.chain), "length": len(self.chain)}
 
     @staticmethod
-    def valid_proof(last_proof, proof):
+    def valid_proof(last_proof, proof, target=DEFAULT_TARGET):
         """Validates proof of work"""
-        guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
+        return mining.valid_proof(last_proof, proof, target)
+
+    def register_node(self, address):
+        """Add a new node to the list of n/w nodes, given as a URL or as host:port"""
+        # Get node URL address
+        parsed_url = urlparse(address if "//" in address else f"//{address}")
+        if not parsed_url.hostname or not parsed_url.port:
+            raise ValueError(f"Node address {address!r} needs a host and a port")
+
+        self.nodes.add(parsed_url.netloc)
+
+    def register_nodes(self, nodes):
+        if not nodes:
+            raise ValueError("Please supply a valid list of nodes")
+        else:
+            for node in nodes:
+                self.register_node(node)
 
-        return guess_hash[:4] == "0000"
+        return "New nodes have been added\nNodes: {}".format(list(self.nodes))
 
-    # def register_node(self, address):
-    #     """Add a new node to the list of n/w nodes"""
-    #     Get node URL address
-    #     parsed_url = urlparse(address)
-    #     self.nodes.add((parsed_url.netloc))
-    #
-    #     self.nodes.add(address)
+    def new_block(self, proof, previous_hash=None, target=None, transactions=None):
+        """Creates a new block and adds it to the chain
 
-    def new_block(self, proof, previous_hash=None):
-        """Creates a new block and adds it to the chain"""
+        The target is the one the proof was searched against; it defaults to whatever the retargeter sets next.
+        The block is sealed here: its digest is computed once and stored in the block as "block_hash".
+        Without explicit transactions, the block takes the next batch from the mempool that fits the block size limits.
+        """
+        if transactions is None:
+            transactions = self.mempool.take(self.max_block_transactions, self.max_block_bytes)
         block = {
             "index": len(self.chain) + 1,
             "timestamp": time(),
-            "transactions": self.current_transactions,
+            "transactions": transactions,
             "proof": proof,
+            "target": target or self.retargeter.next_target(self.chain),
             "previous_hash": previous_hash or self.create_hash(self.chain[-1]),
-            "block_hash": self.block_hash
+            "merkle_root": merkle.merkle_root(transactions),
         }
-
-        self.current_transactions = []  # Reset the current transactions list
-        self.chain.append(block)  # Add new block to chain
+        block["block_hash"] = block_codec.block_hash(block)
+        self._append(block)
 
         return block
 
-    def create_hash(self, block):
+    def add_block(self, block):
+        """Adds a block received from a peer to the block tree, switching our chain to its branch if that has more work
+
+        The block must follow a block in the tree, i.e. our last block, a block on a competing branch or one of our
+        recent blocks, and be sealed against the target our retargeter sets on its branch, with a valid proof of work,
+        digest and Merkle root. Returns False and leaves the chain unchanged otherwise; a block on a branch with less
+        work than ours is kept in the tree in case the branch overtakes our chain later. So is a block whose branch
+        forked from our chain below the blocks the tree keeps, but such a fork is refused and False is returned.
+        """
+        if block["block_hash"] in self.block_heights or not self.tree.add(block, self.retargeter):
+            return False
+
+        if self.tree.work[block["block_hash"]] > self.work:
+            fork, blocks = self.tree.branch(block["block_hash"], lambda block_hash: block_hash in self.block_heights)
+            if fork is None:
+                return False  # Deeper than reorg_depth
+            self._reorg(fork, blocks)
+        return True
+
+    def replace_chain(self, blocks):
+        """Adds a peer's blocks past our fork point with it; returns True if our chain switched to them
+
+        The blocks must follow on from each other, the first from a block in the tree. Each is checked against the
+        target our retargeter sets for it, and our chain only switches if the peer's carry more work. A fork deeper
+        than the block tree's `max_depth` can't be switched to.
+        """
+        for block in blocks:
+            known = block["block_hash"] in self.tree or block["block_hash"] in self.block_heights
+            if not known and not self.add_block(block):
+                return False
+
+        return bool(blocks) and self.last_block["block_hash"] == blocks[-1]["block_hash"]
+
+    def _reorg(self, fork, blocks):
+        """Switch the chain to the blocks of a branch of the tree after `fork`, the hash of a block in our chain
+
+        Only the blocks past the fork point are undone and applied, so a reorg costs the depth of the fork rather than
+        the length of the chain. The transactions of the blocks undone go back to the mempool unless the new branch
+        includes them, and the new branch's transactions leave it.
+        """
+        start = self.block_heights[fork] + 1
+
+        dropped = [self.chain[height] for height in range(start, len(self.chain))]
+        for height, block in reversed(list(enumerate(dropped, start))):
+            if self.tx_index.next_height == height + 1:
+                self.tx_index.remove_last_block(block)
+            self.work -= expected_work(block["target"])
+        if isinstance(self.chain, list):
+            del self.chain[start:]
+            for block in dropped:
+                del self.block_heights[block["block_hash"]]
+        else:
+            self.chain.truncate(start)  # Drops the blocks from block_heights, which is the store's own index
+        self.validator.rewind(start - 1, fork)
+
+        included = set()
+        for block in blocks:
+            self._append(block)
+            for transaction in block["transactions"]:
+                included.add(self.mempool.key(transaction))
+                self.mempool.discard(self.mempool.key(transaction))
+        for block in dropped:
+            for transaction in block["transactions"]:
+                if self.mempool.key(transaction) not in included:
+                    self.mempool.add(transaction)
+
+    def _append(self, block):
+        self.chain.append(block)  # Add new block to chain
+        self.work += expected_work(block["target"])
+        self.block_heights[block["block_hash"]] = len(self.chain) - 1
+        if self.tx_index.next_height == len(self.chain) - 1:
+            self.tx_index.add_block(block)  # A reopened chain is indexed on its first query instead
+        if block["block_hash"] not in self.tree:
+            self.tree.add_trusted(block, len(self.chain) - 1, self.work)
+
+    def _seed_tree(self):
+        """Add the last blocks of a reopened chain to the block tree, so forks off them can still be switched to"""
+        start = max(len(self.chain) - 1 - self.tree.max_depth, 0)
+        blocks = [self.chain[height] for height in range(start, len(self.chain))]
+        work = self.work - sum(expected_work(block["target"]) for block in blocks[1:])
+        for height, block in enumerate(blocks, start):
+            if height > start:
+                work += expected_work(block["target"])
+            self.tree.add_trusted(block, height, work)
+
+    @staticmethod
+    def create_hash(block):
         """Create a hash digest of a block
 
-        Hash object has to be a bytes or bytearray, so the pickled block is converted to bytes
+        Sealed blocks already carry their digest, so it is only computed from the block's canonical encoding when the
+        block hasn't been sealed yet.
         """
-        self.pickle_block = block
-        return hashlib.sha256(b"self.pickle_block").hexdigest()
+        return block.get("block_hash") or block_codec.block_hash(block)
 
-    def proof_of_work(self, last_proof):
+    def proof_of_work(self, last_proof, target=DEFAULT_TARGET):
         """Proof of work algorithm.
 
-        Find a number (p`) such that hash(pp`) contains 4 ending zeros, where p is the previous p`
+        Find a number (p`) such that hash(pp`) is below the target, where p is the previous p`
         'p' is the previous proof; 'p`' is the new proof
         """
-        proof = 0
-        while not self.valid_proof(last_proof, proof):
-            proof += 1
+        if self.miner is not None:
+            return self.miner.proof_of_work(last_proof, target)
 
-        return proof
+        return mining.serial_proof_of_work(last_proof, target)
 
     def mine(self, sender, recipient, cmd_and_hash):
         """Mines a new block"""
-        # Get next proof
-        self.last_proof = self.last_block["proof"]
-        self.proof = self.proof_of_work(self.last_proof)
-
         # Mine a new coin
         self.add_transaction(sender, recipient, cmd_and_hash)
 
-        # Add new block to chain
-        self.previous_hash = self.create_hash(self.last_block)
-        self.block = self.new_block(self.proof, self.previous_hash)
-        self.block_hash = self.create_hash(self.block)
+        # Get next proof and add new block to chain
+        self.mine_batch()
 
         response = {
             "message": "New block forged",
             "index": self.block["index"],
             "transactions": self.block["transactions"],
             "proof": self.block["proof"],
+            "target": self.block["target"],
             "previous_hash": self.block["previous_hash"],
+            "merkle_root": self.block["merkle_root"],
             "current_block_hash": self.block["block_hash"]
         }
 
         return response
 
-    def new_transaction(self, sender, recipient, cmd_and_hash):
-        """Adds a new transaction to the list of transactions.
+    def block_template(self, max_transactions=None, max_bytes=None):
+        """Takes the transactions of the next block from the mempool, as many as fit the size limits
+
+        The limits default to the blockchain's block size limits. Returns (transactions, last_proof, target); the block
+        is sealed by passing a proof of work for last_proof against target to new_block, with the target and
+        transactions.
+        """
+        transactions = self.mempool.take(max_transactions or self.max_block_transactions,
+                                         max_bytes or self.max_block_bytes)
+
+        return transactions, self.last_block["proof"], self.retargeter.next_target(self.chain)
 
-        The returned index is the index of the next transaction to be mined.
+    def mine_batch(self, max_transactions=None, max_bytes=None):
+        """Mines one block from as many pending transactions as fit the size limits
+
+        The limits default to the blockchain's block size limits. Returns statistics for the block: the number of
+        transactions, the size of its canonical encoding in bytes and the seconds spent sealing it.
         """
-        self.current_transactions.append({"sender": sender, "recipient": recipient, "cmd_tuple": cmd_and_hash})
+        started = perf_counter()
+        transactions, self.last_proof, self.target = self.block_template(max_transactions, max_bytes)
+
+        # Get next proof
+        self.proof = self.proof_of_work(self.last_proof, self.target)
+
+        # Add new block to chain
+        self.previous_hash = self.create_hash(self.last_block)
+        self.block = self.new_block(self.proof, self.previous_hash, self.target, transactions)
+        self.block_hash = self.block["block_hash"]
+
+        return {
+            "index": self.block["index"],
+            "block_hash": self.block_hash,
+            "transactions": len(transactions),
+            "bytes": len(block_codec.encode(self.block)),
+            "seal_latency": perf_counter() - started,
+        }
+
+    def mine_from(self, transactions, max_transactions=None, max_bytes=None, max_wait=None):
+        """Mines blocks from a stream of (sender, recipient, cmd_and_hash) transactions
+
+        A block is sealed as soon as the pending transactions reach `max_transactions` or `max_bytes`, or the oldest of
+        them has waited `max_wait` seconds, whichever comes first. The stream is read in a thread and the wait is
+        timed from the first transaction the mempool accepts, so a stalled stream doesn't hold up the pending ones and
+        a rejected duplicate doesn't start a block of its own. Whatever is pending when the stream ends goes into a
+        last block. Yields the statistics of every block mined, as returned by mine_batch. The stream stops being read
+        when the generator is closed or raises.
+        """
+        max_transactions = max_transactions or self.max_block_transactions
+        max_bytes = max_bytes or self.max_block_bytes
+        arrivals = queue.Queue(max_transactions or 1000)
+        stopped = threading.Event()
+        threading.Thread(target=_read_transactions, args=(transactions, arrivals, stopped), daemon=True).start()
+        first_pending = None
+
+        try:
+            while True:
+                timeout = None
+                if first_pending is not None and max_wait is not None:
+                    timeout = max(first_pending + max_wait - perf_counter(), 0)
+                try:
+                    item, error = arrivals.get(timeout=timeout)
+                except queue.Empty:
+                    item = None  # The oldest pending transaction has waited long enough
+
+                if item is _DONE:
+                    if error is not None:
+                        raise error
+                    break
+                if item is not None:
+                    sender, recipient, cmd_and_hash = item
+                    if self.add_transaction(sender, recipient, cmd_and_hash) is not None and first_pending is None:
+                        first_pending = perf_counter()
+
+                if first_pending is None:
+                    continue
+                full = ((max_transactions and len(self.mempool) >= max_transactions) or
+                        (max_bytes and self.mempool.size_bytes >= max_bytes))
+                if item is None or full or (max_wait is not None and perf_counter() - first_pending >= max_wait):
+                    yield self.mine_batch(max_transactions, max_bytes)
+                    first_pending = perf_counter() if len(self.mempool) else None
+        finally:
+            stopped.set()
+
+        while len(self.mempool):
+            yield self.mine_batch(max_transactions, max_bytes)
+
+    def new_transaction(self, sender, recipient, cmd_and_hash, priority=0):
+        """Adds a new transaction to the mempool.
+
+        The returned index is the index of the next block to be mined. None is returned if the mempool already holds
+        the same command between the same sender and recipient or is full of higher priority transactions.
+        """
+        transaction = {"sender": sender, "recipient": recipient, "cmd_tuple": cmd_and_hash}
+        if not self.mempool.add(transaction, priority):
+            return None
 
         return self.last_block["index"] + 1  # Block index of this new transaction
 
-    def add_transaction(self, sender, recipient, cmd):
-        """Add a new transaction to chain."""
+    def add_transaction(self, sender, recipient, cmd, priority=0):
+        """Add a new transaction to chain; returns its block index, or None if the mempool didn't take it."""
         # Check for valid data
         if not sender:
             raise ValueError("Missing 'sender'")
@@ -161,82 +432,24 @@ class Blockchain:
             self.modbus_cmd = cmd
 
         # Make new transaction
-        self.new_transaction(self.sender, self.recipient, self.modbus_cmd)
-        # return "Transaction will be added to block {}".format(index)
-
-    # def valid_chain(self, chain):
-    #     """Determine if a chain is valid"""
-    #     last_block = chain[0]
-    #     current_index = 1
-    #
-    #     while current_index < len(chain):
-    #         block = chain[current_index]
-    #         print("Last block = {}".format(last_block))
-    #         print("Current block = {}".format(block))
-    #         print("\n---------\n")
-    #
-    #         # Check that the current block's hash is correct
-    #         if block["previous_hash"] != self.hash(last_block):
-    #             return False
-    #
-    #         # Check proof of work is correct
-    #         if not self.valid_proof(last_block["proof"], block["proof"]):
-    #             return False
-    #
-    #         last_block = block
-    #         current_index += 1
-    #
-    #     return True
-
-    # def resolve_conflicts(self):
-    #     """Consensus algorithm
-    #
-    #     Resolves conflicts by replacing current chain with longest one on n/w. Assumes longest chain is the only
-    #     valid chain.
-    #     """
-    #     neighbors = self.nodes
-    #     new_chain = None
-    #
-    #     # Look for chains longer than current
-    #     max_length = len(self.chain)
-    #
-    #     # Verify chains from all n/w nodes
-    #     for node in neighbors:
-    #         node_length = node.full_chain()["length"]
-    #         node_chain = node.full_chain()["chain"]
-    #
-    #         # Check if node chain longer than current chain
-    #         if node_length > max_length and self.valid_chain(node_chain):
-    #             max_length = node_length
-    #             new_chain = node_chain
-    #
-    #     # Replace current chain if node chain is longer
-    #     if new_chain:
-    #         self.chain = new_chain
-    #         return True
-    #
-    #     return False
-
-    # def register_nodes(self, nodes):
-    #     if not nodes:
-    #         raise ValueError("Please supply a valid list of nodes")
-    #     else:
-    #         for node in nodes:
-    #             self.register_node(node)
-    #
-    #     return "New nodes have been added\nNodes: {}".format(list(self.nodes))
-
-    # def consensus(self):
-    #     replaced = self.resolve_conflicts()
-    #
-    #     if replaced:
-    #         return "Our chain was replaced with {}".format(self.chain)
-    #     else:
-    #         return "Our chain is accurate. Chain is {}".format(self.chain)
+        return self.new_transaction(self.sender, self.recipient, self.modbus_cmd, priority)
+
+    @staticmethod
+    def valid_chain(chain, retargeter=None):
+        """Determine if a chain is valid, checking every block from genesis against a retargeter's targets"""
+        return validation.valid_chain(chain, retargeter)
+
+    def validate(self):
+        """Determine if our own chain is valid, checking only blocks added since it was last validated"""
+        return self.validator.validate(self.chain, self.retargeter)
+
+    def audit(self, workers=None):
+        """Check every block of our chain across a process pool; returns the first invalid height, or None"""
+        return validation.first_invalid_height(self.chain, workers, retargeter=self.retargeter)
 
 
 if __name__ == "__main__":
-    blockchain = Blockchain()
+    blockchain = Blockchain(miner=mining.ParallelMiner())
     transaction = ModbusTransaction()
     transaction.establish_conn()
     node_identifier = "127.0.0.1"
@@ -254,4 +467,3 @@ if __name__ == "__main__":
     print("\n***Full Chain***")
     pprint.pprint(blockchain.full_chain)
     transaction.close_conn()
-# TODO: Figure out why current block hash doesn't change
@@ -1,5 +1,9 @@
 import json
 import hashlib
+from collections import deque
+from itertools import chain as chained
+
+import numpy as np
 
 
 def hash_function(block):
@@ -13,9 +17,8 @@ def hash_function(block):
 def update_state(transaction, state):
     """Updates record of owners.
 
-    Makes a copy of the current state then, for each transaction owner, check if the owner is also present in the
-    state record. If so, add the owner's transaction value to the state value. Otherwise, add the owner and value to the
-    state record.
+    Makes a copy of the current state, then applies the transaction to the copy (see apply_transaction). Copying costs
+    as much as the whole state, so validating many transactions should apply them in place instead.
 
     :param transaction: Dictionary of owner:amount
     :param state: Dictionary of transactions
@@ -23,16 +26,37 @@ def update_state(transaction, state):
     :return: Updated record of owners and amounts
     """
     state = state.copy()
-
-    for key in transaction:
-        if key in state.keys():
-            state[key] += transaction[key]
-        else:
-            state[key] = transaction[key]
+    apply_transaction(transaction, state)
 
     return state
 
 
+def apply_transaction(transaction, state, undo=None):
+    """Updates record of owners in place.
+
+    For each transaction owner, add the owner's transaction value to the owner's state value, starting from zero for an
+    owner not in the state record yet. The cost depends only on the size of the transaction.
+
+    :param transaction: Dictionary of owner:amount
+    :param state: Dictionary of transactions, updated in place
+    :param undo: Optional list; the previous value of every owner touched is appended to it, so revert_transactions
+        can restore the state
+    """
+    for key, amount in transaction.items():
+        if undo is not None:
+            undo.append((key, state.get(key)))  # None if the owner wasn't in the state record
+        state[key] = state.get(key, 0) + amount
+
+
+def revert_transactions(state, undo):
+    """Restores the state record to what it was before the transactions whose undo log is given."""
+    for key, value in reversed(undo):
+        if value is None:
+            del state[key]
+        else:
+            state[key] = value
+
+
 def valid_transaction(transaction, state):
     """A valid transaction must sum to 0.
 
@@ -97,30 +121,29 @@ def check_block_hash(block):
     return  # Empty return not necessary
 
 
-def check_block_validity(block, parent, state):
+def check_block_validity(block, parent, state, undo=None):
     """Check the block has valid parameters.
 
     Parent number is the block number from the previous block in current chain.
     Parent hash is the hash digest from the previous block.
     Block number is the previous block's index value.
 
-    For each transaction in the current block, validate the transaction with the record state. If the transaction is
-    valid, update the record state with the current owner:amount elements. If not valid, raise an exception.
+    First, validate the current block's hash digest. Then, confirm that the current block index number is equal to the
+    parent's index + 1, and that the parent hash digest contained within the block content is equal to the digest
+    stored in the parent block itself.
+
+    Finally, for each transaction in the current block, validate the transaction with the record state. If the
+    transaction is valid, update the record state in place with the current owner:amount elements. If not valid, undo
+    the block's transactions so far and raise an exception, leaving the state as it was.
 
-    Next, validate the current block's hash digest. Then, confirm that the current block index number is equal to the
-    parent's index + 1. Finally, check whether the parent hash digest contained within the block content is equal to
-    the digest stored in the parent block itself.
+    :param undo: Optional list the block's undo log is appended to (see apply_transaction)
+
+    :return: The state, updated in place
     """
     parent_number = parent['contents']['block_number']
     parent_hash = parent['hash']
     block_number = block['contents']['block_number']
 
-    for transaction in block['contents']['transaction']:
-        if valid_transaction(transaction, state):
-            state = update_state(transaction, state)
-        else:
-            raise Exception
-
     check_block_hash(block)  # Check hash integrity
 
     if block_number != parent_number + 1:
@@ -129,6 +152,17 @@ def check_block_validity(block, parent, state):
     if block['contents']['parent_hash'] != parent_hash:
         raise Exception
 
+    block_undo = []
+    for transaction in block['contents']['transaction']:
+        if valid_transaction(transaction, state):
+            apply_transaction(transaction, state, block_undo)
+        else:
+            revert_transactions(state, block_undo)
+            raise Exception
+
+    if undo is not None:
+        undo.extend(block_undo)
+
     return state
 
 
@@ -156,7 +190,7 @@ def check_chain(chain):
     state = {}
 
     for transaction in chain[0]['contents']['transaction']:
-        state = update_state(transaction, state)
+        apply_transaction(transaction, state)
 
     check_block_hash(chain[0])
     parent = chain[0]
@@ -168,28 +202,167 @@ def check_chain(chain):
     return state
 
 
+def replay_balances(chain):
+    """Rebuild the record state of a whole chain at once with NumPy.
+
+    Owners are interned to integer ids and every owner:amount entry of the chain is loaded into arrays in one pass.
+    The sum of every transaction is then computed with a scatter-add (np.add.at), as is each owner's final balance.
+    The running balance of every owner after each of its entries comes from one cumulative sum over the entries
+    grouped by owner, so the rules of valid_transaction (sums to 0, no negative balance) are checked for all
+    transactions together. As in check_chain, the transactions of the genesis block aren't checked. Block hashes and
+    links aren't checked either; check_chain or a Ledger does that.
+
+    :param chain: List of blocks, starting with the genesis block
+
+    :return: Record state after the last valid block, and the number of the first invalid block (None if all are valid)
+    """
+    # Flattened with map and itertools rather than Python loops, which would dominate the replay
+    block_transactions = [block['contents']['transaction'] for block in chain]
+    transactions = list(chained.from_iterable(block_transactions))
+    keys = list(chained.from_iterable(transactions))
+    owner_ids = {key: owner for owner, key in enumerate(dict.fromkeys(keys))}
+
+    owners = np.array(list(map(owner_ids.__getitem__, keys)), dtype=np.int64)
+    amounts = np.array(list(chained.from_iterable(map(dict.values, transactions))))
+    transaction_sizes = np.array(list(map(len, transactions)), dtype=np.int64)
+    transaction_blocks = np.repeat(np.arange(len(chain)), list(map(len, block_transactions)))
+    entry_transactions = np.repeat(np.arange(len(transactions)), transaction_sizes)
+    entry_blocks = transaction_blocks[entry_transactions]
+
+    # Transactions that don't sum to 0
+    sums = np.zeros(len(transactions), dtype=amounts.dtype)
+    np.add.at(sums, entry_transactions, amounts)
+    invalid = transaction_blocks[(sums != 0) & (transaction_blocks > 0)]
+
+    # Balance of the owner after each entry, in chain order within each owner
+    order = np.argsort(owners, kind='stable')
+    sorted_amounts = amounts[order]
+    running = np.cumsum(sorted_amounts)
+    group_starts = np.flatnonzero(np.diff(owners[order], prepend=-1))
+    group_offsets = running[group_starts] - sorted_amounts[group_starts]
+    running -= np.repeat(group_offsets, np.diff(np.append(group_starts, len(order))))
+    overdrawn = entry_blocks[order][(running < 0) & (entry_blocks[order] > 0)]
+
+    first_invalid = min((int(blocks.min()) for blocks in (invalid, overdrawn) if len(blocks)), default=None)
+
+    valid = entry_blocks < (len(chain) if first_invalid is None else first_invalid)
+    balances = np.zeros(len(owner_ids), dtype=amounts.dtype)
+    np.add.at(balances, owners[valid], amounts[valid])
+    present = np.zeros(len(owner_ids), dtype=bool)
+    present[owners[valid]] = True
+    state = {key: balance for (key, owner), balance in zip(owner_ids.items(), balances.tolist()) if present[owner]}
+
+    return state, first_invalid
+
+
 def add_transaction_to_chain(transaction, state, chain):
     """Places the current transaction block into the chain.
 
-    If the transaction is validated, the record state is updated, otherwise an exception is generated.
+    A new block holding the transaction is created and validated against the last block of the chain and the record
+    state, which must be the state after that block. If it is valid, the record state is updated in place and the
+    block is appended to the current chain, otherwise an exception is generated and the record state is left as it was.
 
-    A new block is created and appended to the current chain. For each transaction listed in the current chain, a
-    validation check is made.
+    Only the new block is checked, so appending costs the same however long the chain is; check_chain re-checks the
+    whole chain.
     """
-    if valid_transaction(transaction, state):
-        state = update_state(transaction, state)
-    else:
+    my_block = make_block([transaction], chain)
+    try:
+        state = check_block_validity(my_block, chain[-1], state)
+    except Exception:
         raise Exception('Invalid transaction.')
-
-    my_block = make_block(state, chain)
     chain.append(my_block)
 
-    for transaction in chain:
-        check_chain(transaction)
-
     return state, chain
 
 
+class Ledger:
+    """Chain of owner:amount transactions with its record state kept up to date incrementally.
+
+    Each new block is validated against the current state alone and applied to it in place. The undo log of every
+    recent block is kept, so the last blocks can be taken back off without recomputing the state, and a copy of the
+    state is kept every `snapshot_every` blocks, so a rebuild only replays the blocks after the nearest snapshot.
+
+    :param chain: Chain to keep, starting with its genesis block; it is checked once
+    :param snapshot_every: Blocks between state snapshots
+    :param max_undo: Number of recent blocks that can be undone
+    """
+    def __init__(self, chain, snapshot_every=1000, max_undo=100):
+        self.chain = chain
+        self.snapshot_every = snapshot_every
+        self.state = {}
+        self.snapshots = {}  # Height to (block hash, copy of the state after that block)
+        self.undo_logs = deque(maxlen=max_undo)  # Undo logs of the most recent blocks, oldest first
+        self.rebuild()
+
+    @property
+    def height(self):
+        return len(self.chain) - 1
+
+    def append_block(self, block):
+        """Validates a block against the last block and the current state, then appends it and applies it"""
+        self.chain.append(block)
+        try:
+            self._apply(self.height)
+        except Exception:
+            self.chain.pop()
+            raise
+
+    def add_transaction(self, transaction):
+        """Places a transaction into a new block at the end of the chain; returns the block"""
+        block = make_block([transaction], self.chain)
+        try:
+            self.append_block(block)
+        except Exception:
+            raise Exception('Invalid transaction.')
+
+        return block
+
+    def undo_block(self):
+        """Takes the last block off the chain and reverts its transactions; returns the block"""
+        if not self.undo_logs:
+            raise Exception('No block left to undo; rebuild from an earlier height instead.')
+
+        revert_transactions(self.state, self.undo_logs.pop())
+        self.snapshots.pop(self.height, None)
+
+        return self.chain.pop()
+
+    def rebuild(self, height=None):
+        """Recomputes the state from the nearest snapshot at or below `height`, checking the blocks after it.
+
+        `height` is the tip by default; blocks above it are dropped from the chain. A snapshot whose block is no longer
+        in the chain, e.g. after the chain was edited, is discarded and an earlier one is used.
+        """
+        if height is not None:
+            del self.chain[height + 1:]
+
+        for snapshot_height in sorted(self.snapshots, reverse=True):
+            block_hash, state = self.snapshots[snapshot_height]
+            if snapshot_height <= self.height and self.chain[snapshot_height]['hash'] == block_hash:
+                break
+            del self.snapshots[snapshot_height]
+        else:
+            snapshot_height, state = 0, {}
+            check_block_hash(self.chain[0])
+            for transaction in self.chain[0]['contents']['transaction']:
+                apply_transaction(transaction, state)
+
+        self.state = state.copy()
+        self.undo_logs.clear()
+        for height in range(snapshot_height + 1, len(self.chain)):
+            self._apply(height)
+
+        return self.state
+
+    def _apply(self, height):
+        """Validates the block at `height` against its parent and the current state, and applies it"""
+        undo = []
+        check_block_validity(self.chain[height], self.chain[height - 1], self.state, undo)
+        self.undo_logs.append(undo)
+        if height % self.snapshot_every == 0:
+            self.snapshots[height] = (self.chain[height]['hash'], self.state.copy())
+
+
 if __name__ == "__main__":
     genesis_block = {
         'hash': hash_function({
@@ -213,3 +386,7 @@ if __name__ == "__main__":
                                                         chain=block_chain)
     print(chain_state)
     print(json.dumps(block_chain, sort_keys=True, indent=4))  # Pretty print blockchain
+
+    ledger = Ledger(block_chain)
+    ledger.add_transaction({'Medium': -1, 'Tom': 1})
+    print(ledger.state)
@@ -0,0 +1,148 @@
+"""Pipelined ingest: poll Modbus devices, hash the commands and mine them into blocks, all at the same time.
+
+The three stages run as tasks on one asyncio event loop and are connected by bounded queues:
+
+    poll -> [queue] -> hash -> [queue] -> mine
+
+Polling awaits device I/O, so it never holds up the loop. Proof of work runs in a worker process (or in the
+blockchain's own ParallelMiner), so the loop keeps polling while a block is being mined; the commands that arrive in the
+meantime go into the next block. When mining falls behind, the queues fill up and polling waits for room instead of
+buffering without limit.
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mining
+from Modbus.hashing_server import ModbusTransaction, cmd_hash
+
+_DONE = object()  # Passed down the queues when polling has finished
+
+
+async def mine_block(blockchain, pool, max_transactions=None, max_bytes=None):
+    """Mine one block from a blockchain's pending transactions without holding up the event loop; returns the block
+
+    Proof of work runs in the blockchain's ParallelMiner if it has one and in `pool`, a ProcessPoolExecutor, otherwise.
+    The nonce search holds the GIL, so in a thread it would compete with the loop.
+    """
+    transactions, last_proof, target = blockchain.block_template(max_transactions, max_bytes)
+
+    loop = asyncio.get_running_loop()
+    if blockchain.miner is not None:
+        proof = await loop.run_in_executor(None, blockchain.miner.proof_of_work, last_proof, target)
+    else:
+        proof = await loop.run_in_executor(pool, mining.serial_proof_of_work, last_proof, target)
+
+    return blockchain.new_block(proof, target=target, transactions=transactions)
+
+
+def sync_poller(transaction, sender, recipient):
+    """Poll coroutine that writes a coil through a connected ModbusTransaction in a thread"""
+    async def poll():
+        response = await asyncio.get_running_loop().run_in_executor(None, transaction.write_single_coil)
+        return sender, recipient, response
+
+    return poll
+
+
+class IngestPipeline:
+    """Polls commands, hashes them and mines them into a blockchain concurrently.
+
+    :param blockchain: Blockchain to mine into
+    :param poll: Coroutine function returning (sender, recipient, pymodbus response) for one command
+    :param hash_cmd: Function returning the hash of a pymodbus response
+    :param queue_size: Capacity of each queue between stages
+    :param max_transactions: Commands per block
+    :param max_wait: Seconds the first command of a block may wait for the block to fill up
+    :param pollers: Number of poll calls in flight at once
+    """
+    def __init__(self, blockchain, poll, hash_cmd=None, queue_size=1000, max_transactions=100, max_wait=1.0,
+                 pollers=1):
+        self.blockchain = blockchain
+        self.poll = poll
+        self.hash_cmd = hash_cmd or cmd_hash
+        self.queue_size = queue_size
+        self.max_transactions = max_transactions
+        self.max_wait = max_wait
+        self.pollers = pollers
+        self.stats = {"polled": 0, "committed": 0, "blocks": 0, "elapsed": 0.0, "commands_per_sec": 0.0}
+
+    async def run(self, count):
+        """Poll `count` commands and mine them all; returns the pipeline statistics"""
+        hash_queue = asyncio.Queue(self.queue_size)
+        mine_queue = asyncio.Queue(self.queue_size)
+        started = time.perf_counter()
+
+        with ProcessPoolExecutor(1) as pool:
+            await asyncio.gather(self._poll_stage(count, hash_queue), self._hash_stage(hash_queue, mine_queue),
+                                 self._mine_stage(mine_queue, pool))
+
+        self.stats["elapsed"] = time.perf_counter() - started
+        self.stats["commands_per_sec"] = self.stats["committed"] / self.stats["elapsed"]
+
+        return self.stats
+
+    async def _poll_stage(self, count, hash_queue):
+        remaining = iter(range(count))
+
+        async def poller():
+            for _ in remaining:
+                await hash_queue.put(await self.poll())
+                self.stats["polled"] += 1
+
+        await asyncio.gather(*(poller() for _ in range(self.pollers)))
+        await hash_queue.put(_DONE)
+
+    async def _hash_stage(self, hash_queue, mine_queue):
+        while True:
+            item = await hash_queue.get()
+            if item is _DONE:
+                await mine_queue.put(_DONE)
+                return
+
+            sender, recipient, response = item
+            await mine_queue.put((sender, recipient, (response, self.hash_cmd(response))))
+
+    async def _mine_stage(self, mine_queue, pool):
+        loop = asyncio.get_running_loop()
+        done = False
+
+        while not done:
+            item = await mine_queue.get()
+            if item is _DONE:
+                return
+
+            # Fill the block until it is full, the first command has waited long enough, or polling is over
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_transactions:
+                if mine_queue.empty():
+                    try:
+                        item = await asyncio.wait_for(mine_queue.get(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = mine_queue.get_nowait()
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            for sender, recipient, cmd_and_hash in batch:
+                self.blockchain.add_transaction(sender, recipient, cmd_and_hash)
+
+            block = await mine_block(self.blockchain, pool, self.max_transactions)
+            self.stats["committed"] += len(block["transactions"])
+            self.stats["blocks"] += 1
+
+
+if __name__ == "__main__":
+    from modbus_blockchain import Blockchain
+
+    blockchain = Blockchain()
+    transaction = ModbusTransaction()
+    transaction.establish_conn()
+    pipeline = IngestPipeline(blockchain, sync_poller(transaction, "127.0.0.1", "192.168.10.96"))
+    stats = asyncio.run(pipeline.run(1000))
+    transaction.close_conn()
+    print(f"{stats['committed']} commands in {stats['blocks']} blocks, {stats['commands_per_sec']:.1f} commands/sec")
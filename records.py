@@ -0,0 +1,28 @@
+"""Length-prefixed, CRC-checked records, the framing of chain_store segments and of the tx_index log.
+
+    [payload length: 4 bytes][CRC-32 of payload: 4 bytes][payload]
+
+Files of records are only ever appended to or cut back from their end, so a crash can at worst leave a torn record at
+the end of one. It fails its length or CRC check, and scan() stops before it for the caller to cut it off.
+"""
+import struct
+import zlib
+
+HEADER = struct.Struct(">II")  # Payload length, CRC-32 of payload
+
+
+def pack(payload):
+    """Record holding a payload."""
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def scan(data, offset=0):
+    """Yield (offset, end, payload) of each intact record in `data` from `offset` on, up to the first torn one."""
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        payload = data[offset + HEADER.size:end]
+        if end > len(data) or zlib.crc32(payload) != crc:
+            return
+        yield offset, end, payload
+        offset = end
@@ -0,0 +1,216 @@
+"""Secondary indexes over the Modbus commands in a chain.
+
+Each index maps a key to a posting list of (height, position) pairs, one per transaction, where height is the block's
+position in the chain and position is the transaction's position in that block's list of transactions. Blocks are
+indexed in chain order, so every posting list is sorted and queries on several keys are answered by merging lists
+rather than scanning blocks.
+
+Transactions are indexed by sender, recipient, Modbus unit and by the coil or register addresses the command touched.
+Coils, discrete inputs, holding registers and input registers are separate address spaces, so addresses are indexed
+per table. Read responses don't carry the address they were read from and are only indexed by sender, recipient and
+unit.
+
+An index can be kept in a log file next to a chain_store.ChainStore, so a restarted node doesn't re-read the chain to
+answer its first query. Every indexed block appends one record (see records.py) holding the block's digest and the
+keys of each of its transactions:
+
+    [payload length: 4 bytes][CRC-32 of payload: 4 bytes][JSON [height, block digest, keys]]
+
+Keys are only strings and integers, so JSON holds them and is decoded far faster than the canonical block encoding.
+
+On open the posting lists are rebuilt from the records, keeping them only as long as their blocks are still at the same
+heights of the chain; a torn record or one left over from blocks a reorg dropped is cut off with everything after it.
+Blocks the log is missing are indexed from the chain on the next query, as without a log.
+"""
+import json
+import os
+from bisect import bisect_left
+from collections import defaultdict
+
+import records
+
+COILS = "coils"
+DISCRETE_INPUTS = "discrete_inputs"
+HOLDING_REGISTERS = "holding_registers"
+INPUT_REGISTERS = "input_registers"
+
+# Modbus function code to the table it addresses
+FUNCTION_TABLES = {
+    1: COILS,
+    2: DISCRETE_INPUTS,
+    3: HOLDING_REGISTERS,
+    4: INPUT_REGISTERS,
+    5: COILS,
+    6: HOLDING_REGISTERS,
+    15: COILS,
+    16: HOLDING_REGISTERS,
+    23: HOLDING_REGISTERS,
+}
+
+
+def command_addresses(cmd):
+    """(table, address) pairs a pymodbus response touched."""
+    table = FUNCTION_TABLES.get(getattr(cmd, "function_code", None))
+    address = getattr(cmd, "address", None)
+    if table is None or address is None:
+        return []
+
+    return [(table, address + offset) for offset in range(getattr(cmd, "count", 1) or 1)]
+
+
+class TransactionIndex:
+    """Posting lists of transactions by sender, recipient, unit and address.
+
+    :param path: Log file to keep the index in; the index is only kept in memory if None
+    :param block_heights: Block digest to height of the chain the log is loaded for, e.g. ChainStore.heights
+    """
+    def __init__(self, path=None, block_heights=None):
+        self.postings = defaultdict(list)
+        self.next_height = 0  # Height of the first block not indexed yet
+        self.path = path
+        self._offsets = []  # Offset of each block's record in the log, by height
+        self._log = None
+
+        if path is not None:
+            self._load(block_heights or {})
+            self._log = open(path, "ab")
+
+    def _load(self, block_heights):
+        """Rebuild the posting lists from the log, cutting it after the last record that still matches the chain."""
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as log:
+            data = log.read()
+
+        offset = 0
+        for start, end, payload in records.scan(data):
+            height, block_hash, transaction_keys = json.loads(payload)
+            if height != self.next_height or block_heights.get(block_hash) != height:
+                break
+
+            self._offsets.append(start)
+            self._post(height, [[tuple(key) for key in keys] for keys in transaction_keys])
+            offset = end
+
+        if offset != len(data):
+            os.truncate(self.path, offset)
+
+    @staticmethod
+    def transaction_keys(transaction):
+        """Index keys a transaction is filed under."""
+        cmd = transaction["cmd_tuple"][0]
+
+        yield "sender", transaction["sender"]
+        yield "recipient", transaction["recipient"]
+        unit = getattr(cmd, "unit_id", None)
+        if unit is not None:
+            yield "unit", unit
+        for table, address in command_addresses(cmd):
+            yield "address", table, address
+
+    def add_block(self, block):
+        """Index the transactions of the block at `next_height`."""
+        height = self.next_height
+        transaction_keys = [list(self.transaction_keys(transaction)) for transaction in block["transactions"]]
+
+        if self._log is not None:
+            payload = json.dumps([height, block["block_hash"], transaction_keys], separators=(",", ":")).encode()
+            self._offsets.append(self._log.tell())
+            self._log.write(records.pack(payload))
+        self._post(height, transaction_keys)
+
+    def _post(self, height, transaction_keys):
+        """Add the entries of the block at `next_height` to the posting lists of its transactions' keys."""
+        for position, keys in enumerate(transaction_keys):
+            entry = (height, position)
+            for key in keys:
+                postings = self.postings[key]
+                if not postings or postings[-1] != entry:
+                    postings.append(entry)
+
+        self.next_height += 1
+
+    def remove_last_block(self, block):
+        """Undo add_block for the last block indexed, e.g. when a reorg drops it from the chain.
+
+        Its entries are the last ones of every posting list they are in, so only those lists are touched.
+        """
+        height = self.next_height - 1
+
+        for transaction in block["transactions"]:
+            for key in self.transaction_keys(transaction):
+                postings = self.postings.get(key)
+                while postings and postings[-1][0] == height:
+                    postings.pop()
+                if key in self.postings and not postings:
+                    del self.postings[key]
+
+        if self._log is not None:
+            self._log.flush()
+            os.truncate(self.path, self._offsets.pop())
+            self._log.seek(0, os.SEEK_END)
+        self.next_height = height
+
+    def close(self):
+        if self._log is not None:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
+            self._log = None
+
+    def catch_up(self, chain):
+        """Index any blocks of `chain` that were appended without being indexed, e.g. from a reopened store."""
+        for height in range(self.next_height, len(chain)):
+            self.add_block(chain[height])
+
+    def keys(self, sender=None, recipient=None, unit=None, address=None, table=COILS):
+        """Index keys for the given criteria; criteria left as None are not used."""
+        keys = []
+        if sender is not None:
+            keys.append(("sender", sender))
+        if recipient is not None:
+            keys.append(("recipient", recipient))
+        if unit is not None:
+            keys.append(("unit", unit))
+        if address is not None:
+            keys.append(("address", table, address))
+
+        if not keys:
+            raise ValueError("Please supply at least one of sender, recipient, unit or address")
+
+        return keys
+
+    def query(self, **criteria):
+        """Yield the (height, position) of every transaction matching all criteria, in chain order.
+
+        Takes the same keyword arguments as keys(). The posting lists are merged lazily, so results stream out as they
+        are found.
+        """
+        lists = sorted((self.postings.get(key, []) for key in self.keys(**criteria)), key=len)
+        if not lists[0]:
+            return
+
+        cursors = [0] * len(lists)
+        for entry in lists[0]:
+            for number in range(1, len(lists)):
+                postings = lists[number]
+                cursor = bisect_left(postings, entry, cursors[number])
+                cursors[number] = cursor
+                if cursor == len(postings):
+                    return
+                if postings[cursor] != entry:
+                    break
+            else:
+                yield entry
+
+    def transactions(self, chain, **criteria):
+        """Yield (height, position, transaction) for every match, reading each block from `chain` only once."""
+        block = None
+        block_height = None
+
+        for height, position in self.query(**criteria):
+            if height != block_height:
+                block = chain[height]
+                block_height = height
+            yield height, position, block["transactions"][position]
@@ -0,0 +1,262 @@
+"""Chain validation.
+
+valid_chain checks a whole chain from genesis. ChainValidator remembers the tip it last verified, so validating the
+same chain again only checks the blocks appended since, and it can save that tip as a checkpoint so a restarted node
+only validates the blocks added after the last checkpoint.
+
+Besides its contents and its link to its parent, every block but genesis must carry the target the retargeter sets
+for it, so a chain can't skip the proof of work by sealing its blocks against an easier target.
+
+first_invalid_height checks a whole chain in parallel for audits: contiguous ranges of blocks are verified in worker
+processes, each reading the few blocks before its range that its first block is checked against.
+
+A checkpoint is a small JSON file holding the height and hash of a verified block plus a seal over both. With a key the
+seal is an HMAC, so a checkpoint can't be forged without the key; without one it is a plain SHA-256 digest that only
+guards against corruption.
+"""
+import hashlib
+import hmac
+import json
+import math
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import block_codec
+import merkle
+import mining
+from chain_store import ChainStore
+from difficulty import Retargeter
+
+MAX_CLOCK_DRIFT = 2 * 60 * 60  # Seconds a block's timestamp may be ahead of our clock
+
+_stores = {}  # Read-only stores opened by a worker process, by directory
+
+
+def valid_block(block, parent):
+    """Check a block on its own and against its parent"""
+    if not valid_contents(block):
+        return False
+
+    return valid_link(block, parent)
+
+
+def valid_contents(block):
+    """Check a block's stored digest against its header and its Merkle root against its transactions"""
+    if block_codec.block_hash(block) != block["block_hash"]:
+        return False
+
+    return merkle.merkle_root(block["transactions"]) == block["merkle_root"]
+
+
+def valid_link(block, parent):
+    """Check that a block follows its parent: index, hash link, timestamp and proof of work
+
+    Only the "index", "previous_hash", "timestamp", "proof" and "target" of the block and the "index", "block_hash",
+    "timestamp" and "proof" of the parent are used. The target itself is checked against the retargeter by the
+    callers that know the chain before the block. Retargeting is computed from the timestamps, so a block may not be
+    older than its parent nor more than MAX_CLOCK_DRIFT seconds ahead of our clock.
+    """
+    if block["index"] != parent["index"] + 1:
+        return False
+    if block["previous_hash"] != parent["block_hash"]:
+        return False
+    if not parent["timestamp"] <= block["timestamp"] <= time() + MAX_CLOCK_DRIFT:
+        return False
+
+    return mining.valid_proof(parent["proof"], block["proof"], block["target"])
+
+
+def valid_chain(chain, retargeter=None):
+    """Determine if a chain is valid, starting from genesis"""
+    if not valid_contents(chain[0]):
+        return False
+
+    return valid_range(chain, 1, len(chain), retargeter)
+
+
+def valid_range(chain, start, stop, retargeter=None):
+    """Check blocks start to stop - 1 against their parents and the retargeter; the blocks before start are trusted"""
+    retargeter = retargeter or Retargeter()
+    context = max(start - retargeter.interval - 1, 0)
+
+    return _first_invalid((chain[height] for height in range(context, stop)), context, start, retargeter) is None
+
+
+class _Recent:
+    """The chain before a height, as Retargeter.next_target reads it, from a deque of the blocks just below it"""
+    def __init__(self, blocks, length):
+        self.blocks = blocks
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __getitem__(self, height):
+        if height < 0:
+            height += self.length
+        position = height - (self.length - len(self.blocks))
+        if not 0 <= position < len(self.blocks) or height >= self.length:
+            raise IndexError("Height outside the recent blocks")
+
+        return self.blocks[position]
+
+
+def _first_invalid(blocks, context, start, retargeter):
+    """First invalid height among `blocks`, which start at height `context`, or None if they are all valid
+
+    Blocks below `start` are trusted and only serve as parents and for retargeting.
+    """
+    recent = deque(maxlen=retargeter.interval + 1)  # All Retargeter.next_target reads
+
+    for height, block in enumerate(blocks, context):
+        if height >= start:
+            if not valid_contents(block):
+                return height
+            if height > 0:
+                if block["target"] != retargeter.next_target(_Recent(recent, height)):
+                    return height
+                if not valid_link(block, recent[-1]):
+                    return height
+        recent.append(block)
+
+    return None
+
+
+def _verify_shard(source, start, stop, retargeter):
+    """Verify blocks start to stop - 1 in a worker process; returns the first invalid height in the shard, or None
+
+    `source` is a store directory, or a list of the blocks from `retargeter.interval + 1` below start, which the
+    shard's first block is checked against.
+    """
+    context = max(start - retargeter.interval - 1, 0)
+    if isinstance(source, str):
+        if source not in _stores:
+            _stores[source] = ChainStore(source, read_only=True)
+        blocks = (_stores[source][height] for height in range(context, stop))
+    else:
+        blocks = source
+
+    return _first_invalid(blocks, context, start, retargeter)
+
+
+def first_invalid_height(chain, workers=None, shard_size=None, retargeter=None):
+    """Check every block of a chain across a process pool; returns the first invalid height, or None if it is valid
+
+    `chain` is a list of blocks or a ChainStore. Workers read a store's blocks themselves through read-only memory
+    maps, so only list chains are shipped to the workers. Each worker gets several shards so slow shards even out.
+    Every shard also reads the few blocks below it, so links and targets are checked across shards as well.
+    """
+    workers = workers or mining.available_cpus()
+    retargeter = retargeter or Retargeter()
+    if not shard_size:
+        shard_size = max(math.ceil(len(chain) / (workers * 4)), 1)
+
+    directory = chain.directory if isinstance(chain, ChainStore) else None
+    if directory:
+        chain.sync()  # Workers only see blocks that are in the index on disk
+
+    with ProcessPoolExecutor(workers) as pool:
+        shards = [(start, min(start + shard_size, len(chain))) for start in range(0, len(chain), shard_size)]
+        futures = [pool.submit(_verify_shard, directory or chain[max(start - retargeter.interval - 1, 0):stop],
+                               start, stop, retargeter) for start, stop in shards]
+
+        for future in futures:
+            bad_height = future.result()
+            if bad_height is not None:
+                for pending in futures:
+                    pending.cancel()
+                return bad_height
+
+    return None
+
+
+class ChainValidator:
+    """Validates a chain incrementally from the last verified tip.
+
+    :param checkpoint_path: File to save checkpoints to and load the verified tip from; no checkpoints if None
+    :param checkpoint_every: Save a checkpoint whenever the verified height crosses a multiple of this
+    :param key: Secret bytes to seal checkpoints with an HMAC
+    """
+    def __init__(self, checkpoint_path=None, checkpoint_every=1000, key=None):
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.key = key
+        self.verified_height = -1  # Nothing verified yet
+        self.verified_hash = None
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            self.load_checkpoint()
+
+    def seal(self, height, block_hash):
+        message = f"{height}:{block_hash}".encode()
+        if self.key is None:
+            return hashlib.sha256(message).hexdigest()
+
+        return hmac.new(self.key, message, hashlib.sha256).hexdigest()
+
+    def load_checkpoint(self):
+        """Take the verified tip from the checkpoint file; raises ValueError if its seal doesn't match."""
+        with open(self.checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        height, block_hash = checkpoint["height"], checkpoint["block_hash"]
+        if not hmac.compare_digest(self.seal(height, block_hash), checkpoint["seal"]):
+            raise ValueError("Checkpoint seal doesn't match; it was corrupted or made with another key")
+
+        self.verified_height = height
+        self.verified_hash = block_hash
+
+    def save_checkpoint(self):
+        """Write the verified tip to the checkpoint file, replacing it atomically."""
+        checkpoint = {"height": self.verified_height, "block_hash": self.verified_hash,
+                      "seal": self.seal(self.verified_height, self.verified_hash)}
+
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+
+    def reset(self):
+        """Forget the verified tip, so the next validation starts from genesis."""
+        self.verified_height = -1
+        self.verified_hash = None
+
+    def rewind(self, height, block_hash):
+        """Move the verified tip back to a block that is still in the chain, e.g. the fork point of a reorg."""
+        if self.verified_height > height:
+            self.verified_height = height
+            self.verified_hash = block_hash
+
+    def validate(self, chain, retargeter=None):
+        """Determine if a chain is valid, checking only blocks past the verified tip
+
+        If the block at the verified height isn't the one that was verified (the chain was replaced), the whole chain
+        is checked again.
+        """
+        if self.verified_height >= len(chain) or \
+                (self.verified_height >= 0 and chain[self.verified_height]["block_hash"] != self.verified_hash):
+            self.reset()
+
+        start = self.verified_height + 1
+        if start == 0:
+            if not valid_contents(chain[0]):
+                return False
+            start = 1
+
+        if not valid_range(chain, start, len(chain), retargeter):
+            return False
+
+        last_checkpoint = self.verified_height // self.checkpoint_every
+        self.verified_height = len(chain) - 1
+        self.verified_hash = chain[-1]["block_hash"]
+        if self.checkpoint_path and self.verified_height // self.checkpoint_every > last_checkpoint:
+            self.save_checkpoint()
+
+        return True